@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compare the time taken by no-op builds of a synthetic stack with scons started normally and
+with scons forked from a warm process (scons.fork in botconfig).
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+import bot.config
+import bot.executor
+import bot.scons
+
+SCONSTRUCT = """\
+env = Environment()
+for i in range({files}):
+    env.Command("build/out%d.txt" % i, "src/in%d.txt" % i, Copy("$TARGET", "$SOURCE"))
+"""
+
+def makeStack(root, packages, files):
+    """Create 'packages' directories, each with a SConstruct that copies 'files' files, and return
+    their names in the order they should be built.
+    """
+    names = []
+    for n in range(packages):
+        name = "pkg%03d" % n
+        os.makedirs(os.path.join(root, name, "src"))
+        with open(os.path.join(root, name, "SConstruct"), "w") as sconstruct:
+            sconstruct.write(SCONSTRUCT.format(files=files))
+        for i in range(files):
+            with open(os.path.join(root, name, "src", "in%d.txt" % i), "w") as source:
+                source.write("%s %d\n" % (name, i))
+        names.append(name)
+    return names
+
+def makeConfig(log, fork):
+    config = bot.config.AttributeDict()
+    config.scons.stderr = log
+    config.scons.stdout = log
+    config.scons.echo = logging.DEBUG
+    config.scons.fork = fork
+    return config
+
+def build(config, root, names, jobs):
+    """Build all packages as 'bot build --jobs' would, and return the wall time."""
+    executor = bot.executor.LocalExecutor(config, jobs=jobs)
+    start = time.time()
+    bot.executor.schedule(names, None if jobs == 1 else {},
+                          lambda name: executor.run(name, os.path.join(root, name), ("-Q",)),
+                          slots=jobs)
+    return time.time() - start
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Time no-op scons builds of a synthetic stack, with and without scons.fork",
+    )
+    parser.add_argument("--packages", "-p", metavar="N", type=int, default=50,
+                        help="number of packages in the synthetic stack")
+    parser.add_argument("--files", "-f", metavar="N", type=int, default=10,
+                        help="number of files built by each package")
+    parser.add_argument("--repeat", "-r", metavar="N", type=int, default=3,
+                        help="number of no-op builds to time for each mode (the best is reported)")
+    parser.add_argument("--jobs", "-j", metavar="N", type=int, default=1,
+                        help="number of packages to build at once")
+    parser.add_argument("--keep", metavar="DIR", type=str, default=None,
+                        help="create the stack in DIR and leave it there, instead of a temporary directory")
+    args = parser.parse_args(argv)
+
+    root = args.keep if args.keep is not None else tempfile.mkdtemp(prefix="bot-benchmark-")
+    try:
+        names = makeStack(root, args.packages, args.files)
+        with open(os.path.join(root, "scons.log"), "w") as log:
+            build(makeConfig(log, False), root, names, args.jobs)  # the initial, real build
+            results = {}
+            for fork in (False, True):
+                config = makeConfig(log, fork)
+                results[fork] = min(build(config, root, names, args.jobs) for i in range(args.repeat))
+        print "%d packages, %d files each, %d at a time:" % (args.packages, args.files, args.jobs)
+        print "  scons started normally:  %7.2fs (%.3fs per package)" % (
+            results[False], results[False] / args.packages)
+        print "  scons forked (warm):     %7.2fs (%.3fs per package)" % (
+            results[True], results[True] / args.packages)
+        print "  speedup:                 %7.2fx" % (results[False] / results[True])
+    except bot.scons.Error as err:
+        sys.exit("%s; see %s" % (err, os.path.join(root, "scons.log")))
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 import os
-import re
 import sys
+import shutil
+import tempfile
 import subprocess
 import argparse
+import multiprocessing.pool
 import eups
 
 def findDir(relatives):
@@ -15,12 +17,84 @@ def findDir(relatives):
                 return result
     return None
 
+def readManifest(filename):
+    """Read a list of (name, version) pairs from a file with one product per line, where the version
+    defaults to 'system' and anything after '#' is a comment.
+
+    Repeated lines are ignored, but a product listed with two different versions is an error.
+    """
+    products = []
+    versions = {}
+    with open(filename, "r") as manifest:
+        for line in manifest:
+            words = line.split("#")[0].split()
+            if not words:
+                continue
+            if len(words) > 2:
+                raise ValueError("Invalid line in manifest %s: %r" % (filename, line))
+            name, version = words[0], (words[1] if len(words) > 1 else "system")
+            if name in versions:
+                if versions[name] != version:
+                    raise ValueError("Manifest %s lists %s with different versions: %s and %s"
+                                     % (filename, name, versions[name], version))
+                continue
+            versions[name] = version
+            products.append((name, version))
+    return products
+
+def readRemap(filename):
+    """Return the contents of a manifest.remap file as a dict of {name: version}."""
+    remap = {}
+    if os.path.isfile(filename):
+        with open(filename, "r") as remapFile:
+            for line in remapFile:
+                words = line.split("#")[0].split()
+                if len(words) == 2:
+                    remap[words[0]] = words[1]
+    return remap
+
+def appendRemap(filename, products):
+    """Add (name, version) entries to a manifest.remap file, replacing it atomically."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    output = tempfile.NamedTemporaryFile(dir=directory, prefix=".manifest.remap.", delete=False)
+    try:
+        if os.path.isfile(filename):
+            with open(filename, "r") as remapFile:
+                contents = remapFile.read()
+            output.write(contents)
+            if contents and not contents.endswith("\n"):
+                output.write("\n")
+            shutil.copymode(filename, output.name)
+        for name, version in products:
+            output.write("%s %s\n" % (name, version))
+        output.close()
+        os.rename(output.name, filename)
+    except Exception:
+        output.close()
+        os.remove(output.name)
+        raise
+
+def cloneExternal(external, externalUrl, name):
+    """Clone the LSST external repo for a product if it isn't already present, returning its path."""
+    externalRepo = os.path.join(external, name)
+    if not os.path.isdir(externalRepo):
+        url = "%s/%s.git" % (externalUrl, name)
+        print "Cloning external git repo from %s" % url
+        subprocess.check_call(("git", "clone", "--quiet", url, externalRepo))
+    return externalRepo
+
 def main(argv):
     parser = argparse.ArgumentParser(
         description="Declare a dummy EUPS product for a package already available in /usr or /usr/local",
     )
-    parser.add_argument("name", metavar="NAME", type=str, help="name of the EUPS product to declare")
+    parser.add_argument("name", metavar="NAME", type=str, nargs="?",
+                        help="name of the EUPS product to declare")
     parser.add_argument("version", nargs="?", type=str, default="system", help="EUPS version 'number'")
+    parser.add_argument("--manifest", "-m", metavar="FILE", type=str, default=None,
+                        help="declare all products listed in FILE, which should have one product name "
+                        "and optional version per line, instead of a single NAME")
+    parser.add_argument("--jobs", "-j", metavar="N", type=int, default=8,
+                        help="number of external repos to clone concurrently in --manifest mode")
     parser.add_argument("--remap", metavar="FILE", type=str,
                         help="Full path to the 'manifest.remap' file, to ensure usage by eups distrib",
                         default=os.path.join(os.environ["EUPS_PATH"].split(":")[0], "site", "manifest.remap"))
@@ -36,6 +110,18 @@ def main(argv):
                         default='none')
     args = parser.parse_args(argv)
 
+    if args.manifest is not None:
+        if args.name is not None:
+            parser.error("NAME may not be given with --manifest")
+        try:
+            products = readManifest(args.manifest)
+        except (IOError, ValueError) as err:
+            parser.error(str(err))
+    elif args.name is not None:
+        products = [(args.name, args.version)]
+    else:
+        parser.error("NAME or --manifest must be given")
+
     if args.external is None and args.buildFiles is None:
         args.external = findDir(["../external", "external"])
         if args.external is None:
@@ -47,48 +133,55 @@ def main(argv):
     if args.external is not None and args.buildFiles is not None:
         parser.error("Only one of --external and --buildFiles may be specified")
 
+    # check manifest.remap before doing anything, so we don't declare half of a conflicting batch
+    remap = readRemap(args.remap)
+    conflicts = ["%s (manifest.remap has %s)" % (name, remap[name]) for name, version in products
+                 if name in remap and remap[name] != version]
+    if conflicts:
+        parser.error("manifest.remap already includes entries with different versions for: %s"
+                     % ", ".join(conflicts))
+
     if args.external is not None:
-        externalRepo = os.path.join(args.external, args.name)
-        if not os.path.isdir(externalRepo):
-            externalUrl = "%s/%s.git" % (args.external_url, args.name)
-            print "Cloning external git repo from %s" % externalUrl
-            subprocess.check_call(("git", "clone", externalUrl, externalRepo))
-        tableFile = os.path.join(externalRepo, "ups", "%s.table" % args.name)
-        extrasDir = os.path.join(externalRepo, "ups")
-    else:
-        tableFile = os.path.join(args.buildFiles, "%s.table" % args.name)
-        extrasDir = os.path.join(args.buildFiles, args.name)
-    if not os.path.isfile(tableFile):
-        tableFile = 'none'
-    else:
-        tableFile = open(tableFile, 'r')
-    if not os.path.isdir(extrasDir):
-        extraFiles = []
+        pool = multiprocessing.pool.ThreadPool(max(1, min(args.jobs, len(products))))
+        try:
+            repos = pool.map(lambda name: cloneExternal(args.external, args.external_url, name),
+                             [name for name, version in products])
+        finally:
+            pool.close()
+        sources = [(os.path.join(repo, "ups", "%s.table" % name), os.path.join(repo, "ups"))
+                   for repo, (name, version) in zip(repos, products)]
     else:
-        extraFiles = [(os.path.join(extrasDir, f), f) for f in os.listdir(extrasDir)
-                      if not f.endswith("table") and f != "eupspkg.cfg.sh"]
-    print ("Declaring %s %s with productDir %s and %d extra files"
-           % (args.name, args.version, args.productDir, len(extraFiles)))
-    eups.declare(productName=args.name, versionName=args.version, productDir=args.productDir,
-                 tablefile=tableFile, externalFileList=extraFiles)
-
-    if os.path.isfile(args.remap):
-        remapRegex = re.compile("^\s*%s\s*(\s+(?P<version>\S+))$" % args.name)
-        remapFile = open(args.remap, "r")
-        for line in remapFile:
-            m = remapRegex.match(line.split("#")[0])
-            if m:
-                if m.group("version") == args.version:
-                    print "manifest.remap already includes an entry for this version; leaving unchanged"
-                    return
-                else:
-                    parser.error("manifest.remap already includes an entry for this product with version %s"
-                                 % m.group("version"))
-    try:
-        with open(args.remap, "a") as remapFile:
-            remapFile.write("%s %s\n" % (args.name, args.version))
-    except Exception as err:
-        parser.error("remap file %s cannot be opened for appending: %s" % (args.remap, err))
+        sources = [(os.path.join(args.buildFiles, "%s.table" % name), os.path.join(args.buildFiles, name))
+                   for name, version in products]
+
+    eupsObj = eups.Eups()
+    for (name, version), (tableFile, extrasDir) in zip(products, sources):
+        if not os.path.isfile(tableFile):
+            tableFile = 'none'
+        else:
+            tableFile = open(tableFile, 'r')
+        if not os.path.isdir(extrasDir):
+            extraFiles = []
+        else:
+            extraFiles = [(os.path.join(extrasDir, f), f) for f in os.listdir(extrasDir)
+                          if not f.endswith("table") and f != "eupspkg.cfg.sh"]
+        print ("Declaring %s %s with productDir %s and %d extra files"
+               % (name, version, args.productDir, len(extraFiles)))
+        eups.declare(productName=name, versionName=version, productDir=args.productDir,
+                     tablefile=tableFile, externalFileList=extraFiles, eupsenv=eupsObj)
+
+    new = []
+    for name, version in products:
+        if name in remap:
+            print "manifest.remap already includes an entry for %s %s; leaving unchanged" % (name, version)
+        else:
+            remap[name] = version
+            new.append((name, version))
+    if new:
+        try:
+            appendRemap(args.remap, new)
+        except Exception as err:
+            parser.error("remap file %s cannot be updated: %s" % (args.remap, err))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 import os
 import sys
+import hashlib
+import tarfile
+import tempfile
 import argparse
 import subprocess
+import multiprocessing.pool
 import eups
 
 def findDir(relatives):
@@ -13,48 +17,161 @@ def findDir(relatives):
                 return result
     return None
 
+def readBatch(filename):
+    """Read a list of (name, version, source directory, dependencies) tuples from a file with one
+    package per line, in the form 'NAME VERSION DIR [DEP ...]'; anything after '#' is a comment.
+    """
+    packages = []
+    with open(filename, "r") as batch:
+        for line in batch:
+            words = line.split("#")[0].split()
+            if not words:
+                continue
+            if len(words) < 3:
+                raise ValueError("Invalid line in batch file %s: %r" % (filename, line))
+            packages.append((words[0], words[1], os.path.abspath(words[2]), words[3:]))
+    return packages
+
+def cacheKey(sourceDir):
+    """Return a hash of the source tree and the Python that will build it."""
+    key = hashlib.sha1()
+    key.update(sys.executable)
+    key.update(sys.version)
+    for dirPath, dirNames, fileNames in os.walk(sourceDir):
+        dirNames[:] = sorted(d for d in dirNames if d not in (".git", "build", "dist")
+                             and not d.endswith(".egg-info"))
+        for fileName in sorted(fileNames):
+            if fileName.endswith(".pyc"):
+                continue
+            path = os.path.join(dirPath, fileName)
+            key.update(os.path.relpath(path, sourceDir))
+            with open(path, "rb") as f:
+                key.update(hashlib.sha1(f.read()).digest())
+    return key.hexdigest()
+
+def install(name, sourceDir, productDir, cacheDir):
+    """Install a single package into productDir, reusing a cached build if one is available.
+
+    Returns a message describing the outcome, or raises RuntimeError.
+    """
+    archive = None
+    if cacheDir is not None:
+        archive = os.path.join(cacheDir, "%s-%s.tar.gz" % (name, cacheKey(sourceDir)))
+        if os.path.exists(archive):
+            with tarfile.open(archive, "r:gz") as tar:
+                tar.extractall(productDir)
+            return "Installed %s from cache" % name
+    logName = os.path.join(productDir, "install.log")
+    if not os.path.isdir(productDir):
+        os.makedirs(productDir)
+    with open(logName, "w") as log:
+        status = subprocess.call((sys.executable, "setup.py", "install", "--home=" + productDir),
+                                 cwd=sourceDir, stdout=log, stderr=subprocess.STDOUT)
+    if status != 0:
+        raise RuntimeError("Installing %s failed; see %s" % (name, logName))
+    if archive is not None:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        output = tempfile.NamedTemporaryFile(dir=cacheDir, suffix=".tmp", delete=False)
+        with tarfile.open(fileobj=output, mode="w:gz") as tar:
+            for entry in os.listdir(productDir):
+                if entry not in ("ups", "install.log"):
+                    tar.add(os.path.join(productDir, entry), arcname=entry)
+        output.close()
+        os.rename(output.name, archive)
+    return "Installed %s" % name
+
+def writeTable(eupsObj, name, productDir, deps):
+    """Write the table file for an installed package, with dependencies expanded to the versions
+    currently setup (as 'eups expandtable' would), and return its path.
+    """
+    try:
+        os.makedirs(os.path.join(productDir, "ups"))
+    except OSError:
+        pass
+    tableFile = os.path.join(productDir, "ups", "{}.table".format(name))
+    with open(tableFile, "w") as table:
+        for dep in deps:
+            product = eupsObj.findSetupProduct(dep)
+            if product is None:
+                print "Warning: {} is not setup; not expanding its version in {}".format(dep, tableFile)
+                table.write("setupRequired({})\n".format(dep))
+            else:
+                table.write("setupRequired({} -j {})\n".format(dep, product.version))
+        table.write("envPrepend(PYTHONPATH, {})\n".format(os.path.join("${PRODUCT_DIR}", "lib", "python")))
+        if os.path.isdir(os.path.join(productDir, "bin")):
+            table.write("envPrepend(PATH, {})\n".format(os.path.join("${PRODUCT_DIR}", "bin")))
+    return tableFile
+
 def main(argv):
     parser = argparse.ArgumentParser(
         description="Install a setuptools module in the current directory and declare it to EUPS",
     )
-    parser.add_argument("name", metavar="NAME", type=str, help="name of the EUPS product to declare")
+    parser.add_argument("name", metavar="NAME", type=str, nargs="?", help="name of the EUPS product to declare")
     parser.add_argument("version", nargs="?", type=str, default="system", help="EUPS version 'number'")
 
     parser.add_argument("--productDir", "-r", metavar="DIR", help="root directory for installed product",
                         default=None)
     parser.add_argument("--dep", "-d", action="append", metavar="PRODUCTS", dest="deps", default=["python"],
                         help="names of EUPS products on which this package depends (must be setup)")
+    parser.add_argument("--batch", "-b", metavar="FILE", type=str, default=None,
+                        help="install all packages listed in FILE, one 'NAME VERSION DIR [DEP ...]' per line, "
+                        "instead of the package in the current directory (dependencies are in addition "
+                        "to those given with --dep)")
+    parser.add_argument("--jobs", "-j", metavar="N", type=int, default=4,
+                        help="number of packages to install concurrently in --batch mode")
+    parser.add_argument("--cache", metavar="DIR", type=str,
+                        default=os.path.join(os.path.expanduser("~"), ".cache", "bot", "install-distutils"),
+                        help="directory for cached builds, keyed by source hash and Python version")
+    parser.add_argument("--no-cache", action="store_const", const=None, dest="cache",
+                        help="always build from source, and don't save builds to the cache")
     args = parser.parse_args(argv)
 
-    eupsObj = eups.Eups()
-
-    if args.productDir is None:
-        productDir = os.path.join(eupsObj.path[0], eupsObj.flavor, args.name, args.version)
+    if args.batch is not None:
+        if args.name is not None or args.productDir is not None:
+            parser.error("NAME and --productDir may not be given with --batch")
+        try:
+            packages = readBatch(args.batch)
+        except (IOError, ValueError) as err:
+            parser.error(str(err))
+    elif args.name is not None:
+        packages = [(args.name, args.version, os.getcwd(), [])]
     else:
-        productDir = args.productDir
-
-    subprocess.call("python setup.py install --home=" + productDir, shell=True)
+        parser.error("NAME or --batch must be given")
 
-    depDict = {}
+    eupsObj = eups.Eups()
 
-    tableFile = os.path.join(productDir, "ups", "{}.table".format(args.name))
+    productDirs = []
+    for name, version, sourceDir, deps in packages:
+        if args.productDir is None:
+            productDirs.append(os.path.join(eupsObj.path[0], eupsObj.flavor, name, version))
+        else:
+            productDirs.append(args.productDir)
 
-    with open(tableFile, "w") as table:
-        for dep in args.deps:
-            table.write("setupRequired({})\n".format(dep))
-        table.write("envPrepend(PYTHONPATH, {})".format(os.path.join("${PRODUCT_DIR}", "lib", "python")))
-        if os.path.isdir(os.path.join(productDir, "bin")):
-            table.write("envPrepend(PATH, {})".format(oos.path.join("${PRODUCT_DIR}", "bin")))
+    def work(i):
+        name, version, sourceDir, deps = packages[i]
+        try:
+            return True, install(name, sourceDir, productDirs[i], args.cache)
+        except Exception as err:
+            return False, str(err)
 
+    pool = multiprocessing.pool.ThreadPool(max(1, min(args.jobs, len(packages))))
     try:
-        os.makedirs(os.path.join(productDir, "ups"))
-    except OSError:
-        pass
-
-    subprocess.call("eups expandtable -i " + tableFile, shell=True)
+        results = pool.map(work, range(len(packages)))
+    finally:
+        pool.close()
 
-    eups.declare(productName=args.name, versionName=args.version, productDir=productDir,
-                 tablefile=tableFile)
+    failed = []
+    for (name, version, sourceDir, deps), productDir, (ok, message) in zip(packages, productDirs, results):
+        print message
+        if not ok:
+            failed.append(name)
+            continue
+        tableFile = writeTable(eupsObj, name, productDir, args.deps + deps)
+        eups.declare(productName=name, versionName=version, productDir=productDir,
+                     tablefile=tableFile, eupsenv=eupsObj)
+    if failed:
+        sys.exit("Failed to install: %s" % ", ".join(failed))
 
 
 if __name__ == "__main__":
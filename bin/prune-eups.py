@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import fnmatch
+import argparse
+import eups
+from bot import lock
+
+def matches(name, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+class StackIndex(object):
+    """Lazily-populated index of the bot stacks that product directories belong to.
+
+    Each stack is locked (shared) before it is first read, and stays locked until release(), so a
+    sync in progress finishes before we judge the stack, and no sync starts until we're done.
+    """
+
+    def __init__(self):
+        self.stacks = {}
+        self.locks = []
+
+    def managed(self, stack):
+        """Return the set of packages managed (not inherited) by the stack at the given path, or None
+        if the directory is not a synced bot stack (e.g. it only holds a botconfig shared by the
+        stacks below it).
+        """
+        if stack not in self.stacks:
+            packages = None
+            stackLock = lock.stack(stack, lock.SHARED)
+            listFile = os.path.join(stack, "packages")
+            # a stack being synced for the first time has a lock file, but no package list yet
+            if (os.path.exists(os.path.join(stack, "botconfig"))
+                    and (os.path.exists(stackLock.filename) or os.path.exists(listFile))):
+                self.locks.append(stackLock.acquire())
+                try:
+                    with open(listFile, "r") as file:
+                        packages = set(line.split()[0] for line in file
+                                       if line.strip() and not line.split()[1].startswith("["))
+                except IOError:
+                    pass
+            self.stacks[stack] = packages
+        return self.stacks[stack]
+
+    def release(self):
+        for stackLock in self.locks:
+            stackLock.release()
+        self.locks = []
+
+def findStale(product, stacks):
+    """Return a string describing why a declaration is stale, or None if it isn't."""
+    if not product.dir or product.dir == "none":
+        return None
+    if not os.path.isdir(product.dir):
+        return "product directory %s does not exist" % product.dir
+    if os.path.exists(os.path.join(product.dir, "botconfig")):
+        return None  # a stack's own metapackage, not one of its packages
+    stack, pkg = os.path.split(os.path.normpath(product.dir))
+    managed = stacks.managed(stack)
+    if managed is not None and (pkg != product.name or product.name not in managed):
+        return "not managed by bot stack %s" % stack
+    return None
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=("Undeclare stale EUPS declarations (those whose product directories are gone, or "
+                     "that belong to bot stacks that no longer manage them) and remove tags in bulk"),
+    )
+    parser.add_argument("--product", "-p", metavar="PATTERN", type=str, action="append", default=None,
+                        help="only consider products whose names match this glob pattern; "
+                        "may be used multiple times")
+    parser.add_argument("--version", "-v", metavar="PATTERN", type=str, action="append", default=None,
+                        help="only consider versions that match this glob pattern (e.g. the eups.name of "
+                        "a bot stack); may be used multiple times")
+    parser.add_argument("--untag", "-t", metavar="PATTERN", type=str, action="append", default=[],
+                        help="also remove tags matching this glob pattern from all considered "
+                        "declarations, stale or not; may be used multiple times")
+    parser.add_argument("--keep", "-k", metavar="TAG", type=str, action="append", default=["current"],
+                        help="Name of tag never to remove with --untag; may be used multiple times.")
+    parser.add_argument("--no-undeclare", action="store_false", default=True, dest="undeclare",
+                        help="do not undeclare stale declarations (just apply --untag)")
+    parser.add_argument("--dry-run", "-n", action="store_true", default=False,
+                        help="report what would be done without changing the EUPS database")
+    args = parser.parse_args(argv)
+
+    eupsObj = eups.Eups()
+    stacks = StackIndex()
+    undeclare = []
+    untag = []
+    for product in eupsObj.findProducts():
+        if args.product is not None and not matches(product.name, args.product):
+            continue
+        if args.version is not None and not matches(product.version, args.version):
+            continue
+        reason = findStale(product, stacks) if args.undeclare else None
+        if reason is not None:
+            undeclare.append((product, reason))
+            untag.extend((product, tag) for tag in product.tags)
+        else:
+            untag.extend((product, tag) for tag in product.tags
+                         if matches(tag, args.untag) and tag not in args.keep)
+
+    if args.dry_run:
+        removing, undeclaring = "Would remove", "Would undeclare"
+    else:
+        removing, undeclaring = "Removing", "Undeclaring"
+    for product, tag in untag:
+        print "%s tag %s from %s %s" % (removing, tag, product.name, product.version)
+        if not args.dry_run:
+            eupsObj.unassignTag(tag, product.name, product.version)
+    for product, reason in undeclare:
+        print "%s %s %s: %s" % (undeclaring, product.name, product.version, reason)
+        if not args.dry_run:
+            eupsObj.undeclare(product.name, product.version)
+    print "%d tags and %d declarations %sremoved" % (len(untag), len(undeclare),
+                                                    "would be " if args.dry_run else "")
+    stacks.release()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
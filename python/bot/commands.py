@@ -1,29 +1,51 @@
 from . import repo
 from . import config
+from . import git
+from . import server
+from . import watch
+from . import executor
+from . import report
+from . import lock
 
 import argparse
+import logging
 import os
+import sys
+import shlex
 import shutil
 
 class Command(object):
 
+    # Whether this command can be forwarded to a 'bot serve' daemon.
+    served = True
+
+    # How run() locks the repo set: lock.SHARED if the command only reads the stack's own files,
+    # or lock.EXCLUSIVE if it rewrites them.
+    locking = lock.SHARED
+
     def add_arguments(self, subparsers):
         subparser = subparsers.add_parser(self.name, help=self.__doc__)
         self.setup(subparser)
-        subparser.set_defaults(func=self.run)
+        subparser.set_defaults(func=self.run, command=self)
 
     def setup(self, parser):
         pass
 
     def run(self, args):
-        self.config = config.load(path=args.path)
-        self.repos = repo.RepoSet(self.config)
+        if server.state is not None and server.state.path == os.path.abspath(config.find(args.path)):
+            self.config = server.state.config
+            self.repos = server.state.repos
+        else:
+            self.config = config.load(path=args.path)
+            self.repos = repo.RepoSet(self.config)
+        self.locks = self.repos.lock(self.locking)
 
 class InitCommand(Command):
     """Initialize a repo set by creating a directory with a botconfig file.
     """
 
     name = "init"
+    served = False
 
     def setup(self, parser):
         parser.add_argument("path", metavar="PATH", type=str, nargs='?',
@@ -55,6 +77,7 @@ class SyncCommand(Command):
     """
 
     name = "sync"
+    locking = lock.EXCLUSIVE
 
     def setup(self, parser):
         parser.add_argument("path", metavar="PATH", type=str, nargs='?',
@@ -89,33 +112,137 @@ class BatchCommand(Command):
     def kw(args):
         return dict((k, getattr(args, k)) for k in ("ignore_failed", "inherited"))
 
-class BuildCommand(BatchCommand):
+class SconsCommand(BatchCommand):
+    """Base class for batch commands that run scons, possibly in parallel or on other machines."""
+
+    def setup(self, parser):
+        BatchCommand.setup(self, parser)
+        parser.add_argument("--jobs", metavar="N", type=int, default=1,
+                            help="number of packages to build at once on this machine, as their "
+                            "dependencies allow (default 1)")
+        parser.add_argument("--workers", metavar="WORKER", type=str, action="append", default=None,
+                            help="run scons on a 'bot worker' instead of locally; WORKER is HOST:PORT "
+                            "(see 'bot worker --listen'; the worker token must match), ssh://HOST, or "
+                            "'local'.  May be given multiple times; package directories must be visible "
+                            "to workers at the same paths.")
+
+    def make_executor(self, args):
+        """Return the executor and read the dependency graph if it will be needed."""
+        if args.workers:
+            result = executor.RemoteExecutor(self.config, args.workers)
+        else:
+            result = executor.LocalExecutor(self.config, jobs=args.jobs)
+        if result.slots > 1:
+            self.repos.read_dependencies()
+        return result
+
+class BuildCommand(SconsCommand):
     """Build all managed packages with scons.
     """
 
     name = "build"
 
     def setup(self, parser):
-        BatchCommand.setup(self, parser)
+        SconsCommand.setup(self, parser)
         parser.add_argument("path", metavar="PATH", type=str,
                             help="directory that contains managed repositories.  "
                             "This is mandatory to distinguish it from scons arguments.")
         parser.add_argument("scons_args", metavar="SCONS_ARGS", nargs=argparse.REMAINDER, 
                             help="additional arguments and options will be passed to scons")
+        parser.add_argument("--watch", action="store_true", default=False,
+                            help="instead of building everything, watch for source changes and rebuild "
+                            "changed packages and their dependents until interrupted")
+        parser.add_argument("--delay", metavar="SECONDS", type=float, default=1.0,
+                            help="with --watch, wait until no changes have arrived for this long before "
+                            "rebuilding (default 1)")
+        parser.add_argument("--estimate", action="store_true", default=False,
+                            help="instead of building, predict the total build time (with --jobs or "
+                            "--workers) from the durations of previous builds, and show the critical path")
 
     def run(self, args):
         Command.run(self, args)
         self.repos.read_list()
-        self.repos.build(*args.scons_args, **self.kw(args))
+        if args.estimate:
+            self.repos.read_dependencies()
+            slots = len(args.workers) if args.workers else args.jobs
+            self.repos.estimate(slots=slots, **self.kw(args))
+        elif args.watch:
+            self.repos.read_dependencies()
+            # watch() locks the stack only while each rebuild runs, so sync and declare can get in
+            for held in self.locks:
+                held.release()
+            watch.watch(self.repos, *args.scons_args, delay=args.delay, **self.kw(args))
+        else:
+            runner = self.make_executor(args)
+            try:
+                self.repos.build(*args.scons_args, executor=runner, **self.kw(args))
+            finally:
+                runner.close()
+
+def _shard(value):
+    index, sep, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected I/N, got '{0}'".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard I/N must have 1 <= I <= N, got '{0}'".format(value))
+    return index, count
+
+class TestCommand(SconsCommand):
+    """Run the tests of all managed packages and report the results of each.
+    """
 
-class InstallCommand(BatchCommand):
+    name = "test"
+
+    def setup(self, parser):
+        SconsCommand.setup(self, parser)
+        parser.add_argument("path", metavar="PATH", type=str,
+                            help="directory that contains managed repositories.  "
+                            "This is mandatory to distinguish it from scons arguments.")
+        parser.add_argument("scons_args", metavar="SCONS_ARGS", nargs=argparse.REMAINDER,
+                            help="additional arguments and options will be passed to 'scons tests'")
+        parser.add_argument("--shard", metavar="I/N", type=_shard, default=None,
+                            help="only test every N-th package in dependency order, starting with the "
+                            "I-th (from 1), so N invocations (e.g. on different machines) cover the stack")
+        parser.add_argument("--junit", metavar="FILE", type=str, default=None,
+                            help="write results to FILE as JUnit XML, with one testsuite per package")
+        parser.add_argument("--json", metavar="FILE", type=str, default=None,
+                            help="write results to FILE as JSON")
+
+    def run(self, args):
+        Command.run(self, args)
+        self.repos.read_list()
+        runner = self.make_executor(args)
+        try:
+            results = self.repos.test(*args.scons_args, executor=runner, **self.kw(args))
+        finally:
+            runner.close()
+        if args.junit:
+            report.write_junit(args.junit, results)
+        if args.json:
+            report.write_json(args.json, results, shard=args.shard)
+        counts = report.summarize(results)
+        print "{0} package(s) passed, {1} failed, {2} could not be tested.".format(
+            counts["passed"], counts["failed"], counts["error"])
+        failed = [result["package"] for result in results if result["status"] != "passed"]
+        if failed:
+            raise RuntimeError("Tests failed for package(s): {0}".format(", ".join(failed)))
+
+    @staticmethod
+    def kw(args):
+        d = BatchCommand.kw(args)
+        d["shard"] = args.shard
+        return d
+
+class InstallCommand(SconsCommand):
     """Install and declare all managed packages.
     """
 
     name = "install"
 
     def setup(self, parser):
-        BatchCommand.setup(self, parser)
+        SconsCommand.setup(self, parser)
         parser.add_argument("--tag", action="store", type=str, default=None, 
                             help="EUPS tag for installed packages")
         parser.add_argument("version", metavar="VERSION", type=str,
@@ -129,7 +256,11 @@ class InstallCommand(BatchCommand):
     def run(self, args):
         Command.run(self, args)
         self.repos.read_list()
-        self.repos.install(*args.scons_args, **self.kw(args))
+        runner = self.make_executor(args)
+        try:
+            self.repos.install(*args.scons_args, executor=runner, **self.kw(args))
+        finally:
+            runner.close()
 
     @staticmethod
     def kw(args):
@@ -172,11 +303,31 @@ class SimpleCommand(Command):
         self.repos.read_list()
         getattr(self.repos, self.name)()
 
+class RefsCommand(Command):
+    """List the managed packages whose origin remote has a given branch or tag.
+    """
+
+    name = "refs"
+
+    def setup(self, parser):
+        parser.add_argument("ref", metavar="REF", type=str, help="branch or tag to look for")
+        parser.add_argument("path", metavar="PATH", type=str, nargs='?',
+                            help="directory that contains managed repositories.  "
+                            "If not given, the first parent directory with a botconfig file will be used.")
+        parser.add_argument("--refresh", action="store_true", default=False,
+                            help="list the refs of every remote again, even if the cached lists are recent")
+
+    def run(self, args):
+        Command.run(self, args)
+        self.repos.read_list()
+        self.repos.find_ref(args.ref, refresh=args.refresh)
+
 class CleanCommand(Command):
     """Clean a repo by removing everything but the botconfig file.
     """
 
     name = "clean"
+    served = False
 
     def setup(self, parser):
         parser.add_argument("path", metavar="PATH", type=str, nargs='?',
@@ -187,23 +338,157 @@ class CleanCommand(Command):
             raise RuntimeError("path argument is required for clean")
         if not os.path.exists(os.path.join(args.path, "botconfig")):
             raise RuntimeError("path does not contain a botconfig file")
+        self.locks = [lock.stack(args.path, lock.EXCLUSIVE).acquire()]
         for p1 in os.listdir(args.path):
-            if p1 != "botconfig":
+            if p1 not in ("botconfig", ".bot.lock"):
                 p2 = os.path.join(args.path, p1)
                 if os.path.isdir(p2):
                     shutil.rmtree(p2)
                 else:
                     os.remove(p2)
 
-commands = [InitCommand(), SyncCommand(), BuildCommand(), InstallCommand(), GitCommand(), CleanCommand()]
+class ServeCommand(Command):
+    """Keep a repo set loaded in memory and run other commands for it without startup overhead.
+
+    Commands for the repo set are forwarded to the daemon automatically while it is running
+    (set BOT_NO_SERVE in the environment to run them in-process anyway).  The daemon reloads
+    itself when botconfig or the package list changes.
+    """
+
+    name = "serve"
+    served = False
+
+    def setup(self, parser):
+        parser.add_argument("path", metavar="PATH", type=str, nargs='?',
+                            help="directory that contains managed repositories.  "
+                            "If not given, the first parent directory with a botconfig file will be used.")
+
+    def run(self, args):
+        server.serve(os.path.abspath(config.find(args.path)))
+
+class MultiCommand(Command):
+    """Run sync, git or declare on several stacks at once.
+
+    Base stacks shared by the given stacks are only loaded once, and each git remote is only
+    fetched once; other clones of the same package fetch from the first one.  A stack is
+    processed after its base when both are given.
+    """
 
-def addSimpleCommand(name):
-    cmd = type(name, (SimpleCommand,), {"name": name, "__doc__": getattr(repo.RepoSet, name).__doc__})
+    name = "multi"
+    served = False
+
+    def setup(self, parser):
+        parser.add_argument("operation", choices=("sync", "git", "declare"),
+                            help="operation to perform on each stack")
+        parser.add_argument("stacks", metavar="STACK", type=str, nargs="+",
+                            help="directories that contain managed repositories")
+        parser.add_argument("--jobs", metavar="N", type=int, default=None,
+                            help="number of stacks to process at once (default: all of them)")
+        parser.add_argument("--fetch", action="store_true", default=False,
+                            help="for sync, fetch new changes from origin before checking out")
+        parser.add_argument("--no-declare", action="store_false", default=True, dest="declare",
+                            help="for sync, do not declare products to EUPS")
+        parser.add_argument("--git-args", metavar="ARGS", type=str, default="",
+                            help="for git, the git command line to run in each package, as a single "
+                            "(shell-quoted) string; {pkg} and {ref} are expanded as with 'bot git'")
+        parser.add_argument("--ignore-failed", action="store_true", default=False,
+                            help="for git, ignore repos where the command fails, and just move on")
+        parser.add_argument("--inherited", action="store_true", default=False,
+                            help="for git, also process packages inherited from another stack")
+
+    def run(self, args):
+        if args.operation == "git" and not args.git_args:
+            raise RuntimeError("--git-args is required for 'multi git'")
+        # Load every stack, sharing RepoSets for stacks that are also bases of other stacks.
+        bases = {}
+        paths = []
+        for stack in args.stacks:
+            path = os.path.abspath(stack)
+            if path not in bases:
+                bases[path] = repo.RepoSet(config.load(path), bases=bases)
+            if path not in paths:
+                paths.append(path)
+        for path in paths:
+            try:
+                bases[path].read_list()
+            except RuntimeError:
+                if args.operation != "sync":
+                    raise
+        dependencies = {}
+        for path in paths:
+            base = bases[path].base
+            dependencies[path] = set([os.path.abspath(base.config.path)]) if base is not None else set()
+        fetcher = git.FetchCache()
+        failed = []
+
+        def process(path):
+            repos = bases[path]
+            if dependencies[path] & set(failed):
+                logging.error("Skipping stack '{0}'; its base failed.".format(path))
+                failed.append(path)
+                return
+            logging.info("Running '{0}' on stack '{1}'.".format(args.operation, path))
+            held = repos.lock(lock.SHARED if args.operation == "git" else lock.EXCLUSIVE)
+            try:
+                if args.operation == "sync":
+                    repos.sync(fetch=args.fetch, declare=args.declare, fetcher=fetcher)
+                elif args.operation == "git":
+                    repos.run_git(*shlex.split(args.git_args), ignore_failed=args.ignore_failed,
+                                  inherited=args.inherited)
+                else:
+                    repos.declare()
+            except Exception as err:
+                logging.error("'{0}' failed for stack '{1}': {2}".format(args.operation, path, err))
+                failed.append(path)
+            finally:
+                for held_lock in held:
+                    held_lock.release()
+
+        executor.schedule(paths, dependencies, process, slots=(args.jobs or len(paths)))
+        if failed:
+            raise RuntimeError("'{0}' failed for stack(s): {1}".format(args.operation, ", ".join(failed)))
+
+class WorkerCommand(Command):
+    """Run scons on behalf of 'bot build' or 'bot install --workers' running on another machine.
+    """
+
+    name = "worker"
+    served = False
+
+    def setup(self, parser):
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument("--listen", metavar="[HOST:]PORT", type=str,
+                           help="accept coordinator connections on a TCP port (HOST defaults to "
+                           "localhost); coordinators must present the token in BOT_WORKER_TOKEN or "
+                           "~/.bot/worker-token (created if necessary).  The connection is not encrypted, "
+                           "so only listen on trusted networks")
+        group.add_argument("--stdio", action="store_true", default=False,
+                           help="serve a single coordinator over stdin/stdout (as used by ssh:// workers)")
+        parser.add_argument("--fork", action="store_true", default=False,
+                            help="fork scons from a warm process with SCons already imported, instead "
+                            "of starting it from scratch for each package (see scons.fork in botconfig)")
+
+    def run(self, args):
+        logging.basicConfig(level=logging.INFO)
+        if args.stdio:
+            executor.work(sys.stdin, sys.stdout, fork=args.fork)
+        else:
+            host, sep, port = args.listen.rpartition(":")
+            executor.listen(host or "localhost", int(port), fork=args.fork)
+
+commands = [InitCommand(), SyncCommand(), BuildCommand(), TestCommand(), InstallCommand(), GitCommand(),
+            RefsCommand(), CleanCommand(),
+            ServeCommand(), WorkerCommand(), MultiCommand()]
+
+def addSimpleCommand(name, locking=lock.SHARED):
+    cmd = type(name, (SimpleCommand,), {"name": name, "__doc__": getattr(repo.RepoSet, name).__doc__,
+                                         "locking": locking})
     commands.append(cmd())
 
 addSimpleCommand("list")
-addSimpleCommand("declare")
-addSimpleCommand("undeclare")
+addSimpleCommand("declare", locking=lock.EXCLUSIVE)
+addSimpleCommand("undeclare", locking=lock.EXCLUSIVE)
+addSimpleCommand("env")
 
 def main(argv):
     parser = argparse.ArgumentParser(description="Manage a collection of LSST git repositories.")
@@ -214,6 +499,15 @@ def main(argv):
     for cmd in commands:
         cmd.add_arguments(subparsers)
     args = parser.parse_args(argv)
+    if args.command.served and server.state is None and not os.environ.get("BOT_NO_SERVE"):
+        try:
+            path = os.path.abspath(config.find(args.path))
+        except RuntimeError:
+            path = None
+        if path is not None:
+            status = server.forward(argv, path)
+            if status is not None:
+                sys.exit(status)
     if args.traceback:
         args.func(args)
     else:
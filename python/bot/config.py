@@ -2,7 +2,7 @@ import collections
 import os
 import logging
 
-__all__ = "load", "default_categories"
+__all__ = "load", "find", "files", "default_categories"
 
 class AttributeDict(object):
 
@@ -37,23 +37,23 @@ class AttributeDict(object):
 
 default_categories = ["git", "packages", "eups", "scons"]
 
-def load(path=None, categories=None):
+def find(path=None):
+    """Return the root directory of the repo set containing path (or the current directory).
+    """
     if path is None:
         path = os.getcwd()
         while not os.path.exists(os.path.join(path, "botconfig")):
             path = os.path.abspath(os.path.join(path, ".."))
             if path == "/":
                 raise RuntimeError("No botconfig found in a parent directory and no path specified.")
-    if categories is None:
-        categories = default_categories
-    config = AttributeDict()
-    config.path = path
-    context = {"path": path}
-    for category in categories:
-        context[category] = config._dict.setdefault(category, AttributeDict())
-    files = []
+    return path
+
+def files(path):
+    """Return the botconfig files that apply to the repo set at path, from most to least specific.
+    """
+    result = []
     while os.path.exists(os.path.join(path, "botconfig")):
-        files.append(os.path.abspath(os.path.join(path, "botconfig")))
+        result.append(os.path.abspath(os.path.join(path, "botconfig")))
         path = os.path.abspath(os.path.join(path, ".."))
         if path == "/":
             break
@@ -61,8 +61,19 @@ def load(path=None, categories=None):
     base = os.path.abspath(os.path.join(directory, "..", "..", "botconfig"))
     if not os.path.exists(base):
         logging.warn("Default botconfig file not found; all options must be set in user botconfigs!")
-    if base not in files:
-        files.append(base)
-    for f in reversed(files):
+    if base not in result:
+        result.append(base)
+    return result
+
+def load(path=None, categories=None):
+    path = find(path)
+    if categories is None:
+        categories = default_categories
+    config = AttributeDict()
+    config.path = path
+    context = {"path": path}
+    for category in categories:
+        context[category] = config._dict.setdefault(category, AttributeDict())
+    for f in reversed(files(path)):
         execfile(f, context)
     return config
@@ -1,44 +1,185 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
-import eups.table
 import os
+import sys
+import json
 import logging
+import threading
+import subprocess
 
 __all__ = "get_dependencies"
 
+_handle = None
+
+# Serializes EUPS operations (and the os.environ changes made by setup) across threads.
+lock = threading.RLock()
+
+def _module():
+    """Import and return the eups module; this is deferred until first use because
+    importing EUPS dominates the startup time of simple commands.
+    """
+    import eups.table
+    return eups
+
+def get_eups():
+    """Return a shared Eups object, creating it on first use.
+
+    Constructing an Eups object reads the EUPS database, so we only want to do it once per
+    process (or once per 'bot serve' daemon).
+    """
+    global _handle
+    if _handle is None:
+        _handle = _module().Eups()
+    return _handle
+
+def context():
+    """Return the parts of the environment that determine what an Eups object sees: EUPS_PATH and
+    the other EUPS_* variables, and which products are setup.
+    """
+    return sorted((k, v) for k, v in os.environ.iteritems()
+                  if k.startswith("EUPS_") or k.startswith("SETUP_"))
+
+def reset():
+    """Discard the shared Eups object, so the next get_eups() reads the EUPS database again
+    (e.g. after the environment has changed).
+    """
+    global _handle
+    with lock:
+        _handle = None
+
 def get_dependencies(config, path, pkg, recursive=False):
     """Return immediate dependencies from inspecting a table file.
 
     NOTE: recursive=True has not been tested.
     """
-    e = eups.Eups()
-    t = eups.table.Table(os.path.join(path, "ups", pkg + ".table"))
-    dependencies = t.dependencies(e, recursive=recursive)
+    with lock:
+        e = get_eups()
+        t = _module().table.Table(os.path.join(path, "ups", pkg + ".table"))
+        dependencies = t.dependencies(e, recursive=recursive)
     if recursive:
         dependencies.sort(key=lambda x: x[2])
     for product, optional, depth in dependencies:
         yield product.name, optional
 
 def declare(config, path, pkg, version, tag_only=False):
-    e = eups.Eups()
-    if not tag_only:
-        logging.debug("Declaring {pkg} {version}.".format(pkg=pkg, version=version))
-        e.declare(productName=pkg, versionName=version, productDir=path)
-    for tmp in config.eups.tags:
-        tag = tmp.format(eups=config.eups)
-        logging.debug("Assigning tag {tag} to {pkg}.".format(pkg=pkg, tag=tag))
-        e.assignTag(tag, productName=pkg, versionName=version)
+    with lock:
+        e = get_eups()
+        if not tag_only:
+            logging.debug("Declaring {pkg} {version}.".format(pkg=pkg, version=version))
+            e.declare(productName=pkg, versionName=version, productDir=path)
+        for tmp in config.eups.tags:
+            tag = tmp.format(eups=config.eups)
+            logging.debug("Assigning tag {tag} to {pkg}.".format(pkg=pkg, tag=tag))
+            e.assignTag(tag, productName=pkg, versionName=version)
 
 def undeclare(config, pkg, version):
-    e = eups.Eups()
-    e.undeclare(productName=pkg, versionName=version)
+    with lock:
+        e = get_eups()
+        e.undeclare(productName=pkg, versionName=version)
+
+def declare_installed(pkg, version):
+    """Declare a product installed by 'scons install' to its default location in the first
+    EUPS_PATH directory.
+    """
+    e = get_eups()
+    product_dir = os.path.join(e.path[0], e.flavor, pkg, version)
+    logging.debug("Declaring {pkg} {version} in {dir}.".format(pkg=pkg, version=version, dir=product_dir))
+    e.declare(productName=pkg, versionName=version, productDir=product_dir)
 
 def setup(pkg, version, nodepend=False):
-    e = eups.Eups(max_depth=(0 if nodepend else -1))
+    e = _module().Eups(max_depth=(0 if nodepend else -1))
     e.setup(productName=pkg, versionName=version)
 
+# Run by environment() in a separate Python process: sets up a product (given the directory that
+# contains the eups module, the product's root and its name), and writes the resulting environment
+# to stdout as JSON.
+_SETUP_SCRIPT = """
+import os, sys, json
+sys.path.insert(0, sys.argv[1])
+import eups
+output = sys.stdout
+sys.stdout = sys.stderr
+eups.Eups().setup(productName=sys.argv[3], productRoot=sys.argv[2])
+json.dump(dict(os.environ), output)
+"""
+
+def _baseline():
+    """Return a copy of the environment with every product but EUPS itself unsetup: no SETUP_* or
+    PRODUCT_DIR variables, and no entries in path-like variables that lie within product directories.
+    """
+    env = dict(os.environ)
+    directories = []
+    for name, value in os.environ.iteritems():
+        if name.startswith("SETUP_") and name != "SETUP_EUPS":
+            del env[name]
+            words = value.split()
+            product = words[0] if words else name[len("SETUP_"):]
+            for suffix in ("_DIR", "_DIR_EXTRA"):
+                directory = env.pop(product.upper() + suffix, None)
+                if directory:
+                    directories.append(directory.rstrip("/"))
+    for name, value in env.items():
+        if name.startswith("EUPS_") or ":" not in value and not name.endswith("PATH"):
+            continue
+        entries = value.split(":")
+        kept = [entry for entry in entries
+                if not any(entry == d or entry.startswith(d + "/") for d in directories)]
+        if not kept:
+            del env[name]
+        elif kept != entries:
+            env[name] = ":".join(kept)
+    return env
+
+def environment(path, product):
+    """Return the environment set up by the product whose ups directory is in path, as a dict of
+    {name: (action, value)}, where action is one of "set", "prepend" (value is prepended to any
+    existing value, separated by a colon) or "unset" (value is None).
+
+    The product is set up starting from a clean environment, with nothing but EUPS setup (see
+    _baseline), so the result includes everything the product and its dependencies set, no matter
+    what was already setup when this was called.  Path-like variables are only prepended to, so
+    the user's own entries (e.g. in PATH) are kept.
+
+    The setup is done in a subprocess, so this process' environment (which other threads may be
+    using to start git or scons) is never modified.
+    """
+    before = _baseline()
+    module_dir = os.path.dirname(os.path.dirname(os.path.abspath(_module().__file__)))
+    process = subprocess.Popen((sys.executable, "-c", _SETUP_SCRIPT, module_dir, path, product),
+                               env=before, stdout=subprocess.PIPE)
+    output, unused = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError("Could not setup '{0}' in '{1}'".format(product, path))
+    after = dict((k.encode("utf-8"), v.encode("utf-8")) for k, v in json.loads(output).iteritems())
+    changes = {}
+    for name, value in after.iteritems():
+        old = before.get(name)
+        if old == value:
+            continue
+        if old and value.endswith(":" + old):
+            changes[name] = ("prepend", value[:-len(old) - 1])
+        else:
+            changes[name] = ("set", value)
+    for name in before:
+        if name not in after:
+            changes[name] = ("unset", None)
+    return changes
+
+def declaration_files(product):
+    """Return the EUPS database directories and files that hold the declarations and tags
+    for a product.
+    """
+    result = []
+    for eups_path in get_eups().path:
+        directory = os.path.join(eups_path, "ups_db", product)
+        result.append(directory)
+        if os.path.isdir(directory):
+            result.extend(os.path.join(directory, f) for f in os.listdir(directory))
+    return result
+
 def tag(pkg, version, tag):
-    e = eups.Eups()
-    logging.debug("Assigning tag {tag} to {pkg}.".format(pkg=pkg, tag=tag))
-    e.assignTag(tag, productName=pkg, versionName=version)
-    
+    with lock:
+        e = get_eups()
+        logging.debug("Assigning tag {tag} to {pkg}.".format(pkg=pkg, tag=tag))
+        e.assignTag(tag, productName=pkg, versionName=version)
+
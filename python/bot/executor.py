@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""Executors that run scons for the packages in a RepoSet, and the scheduler that drives them.
+
+LocalExecutor runs scons on this machine (one package at a time by default, as bot always has).
+RemoteExecutor ships each package's scons run to a pool of 'bot worker' processes, reached over
+SSH or a TCP socket; workers must see the package directories (and EUPS_PATH) at the same paths
+as the coordinator, e.g. through a shared filesystem.  Either way, the coordinator remains
+responsible for all EUPS declarations, setups and tags.
+
+A worker listening on a TCP socket runs whatever a coordinator asks it to, so coordinators must
+first present a shared secret token: the value of BOT_WORKER_TOKEN in the environment if set, or
+else the contents of ~/.bot/worker-token (created, readable only by its owner, the first time a
+worker listens).
+"""
+
+from . import scons
+
+import os
+import sys
+import hmac
+import json
+import errno
+import Queue
+import socket
+import logging
+import binascii
+import threading
+import subprocess
+import SocketServer
+
+__all__ = "schedule", "LocalExecutor", "RemoteExecutor", "work", "listen", "token"
+
+TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".bot", "worker-token")
+
+def schedule(packages, dependencies, func, slots=1, priority=None):
+    """Call func(pkg) for each of the given packages, running up to 'slots' calls at once in
+    separate threads, and starting each package only after all of its dependencies among the
+    given packages have finished.
+
+    Packages that are ready at the same time are started in order of decreasing priority (a dict
+    of {pkg: number}, see history.critical_paths) if given, or else in the order they appear in
+    'packages'.  If dependencies is None, each package is assumed to depend on the one before it.
+
+    If func raises, no further packages are started, and the first exception is re-raised once
+    the calls already running have finished.
+    """
+    if dependencies is None:
+        dependencies = dict((pkg, set(packages[:i][-1:])) for i, pkg in enumerate(packages))
+    order = dict((pkg, i) for i, pkg in enumerate(packages))
+    if priority is None:
+        key = order.get
+    else:
+        key = lambda pkg: (-priority[pkg], order[pkg])
+    waiting = dict((pkg, set(dependencies.get(pkg, ())) & set(order)) for pkg in packages)
+    dependents = dict((pkg, []) for pkg in packages)
+    for pkg, deps in waiting.iteritems():
+        for dep in deps:
+            dependents[dep].append(pkg)
+    ready = sorted((pkg for pkg, deps in waiting.iteritems() if not deps), key=key)
+    running = set()
+    errors = []
+    condition = threading.Condition()
+
+    def call(pkg):
+        error = None
+        try:
+            func(pkg)
+        except Exception:
+            error = sys.exc_info()
+        with condition:
+            running.remove(pkg)
+            if error is not None:
+                errors.append(error)
+            else:
+                for dependent in dependents[pkg]:
+                    waiting[dependent].discard(pkg)
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+                ready.sort(key=key)
+            condition.notify()
+
+    if slots == 1:
+        # no threads needed; this keeps tracebacks and interrupts simple in the common case
+        while ready:
+            pkg = ready.pop(0)
+            running.add(pkg)
+            call(pkg)
+            if errors:
+                break
+    else:
+        with condition:
+            while True:
+                while ready and len(running) < slots and not errors:
+                    pkg = ready.pop(0)
+                    running.add(pkg)
+                    thread = threading.Thread(target=call, args=(pkg,), name=pkg)
+                    thread.daemon = True
+                    thread.start()
+                if not running:
+                    break
+                condition.wait(1.0)  # with a timeout, so KeyboardInterrupt is delivered
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+class LocalExecutor(object):
+    """Run scons on this machine, up to 'jobs' packages at a time.
+
+    With jobs=1, scons output goes directly to the scons log as it is produced; otherwise each
+    package's output is captured and written to the log when it finishes.
+    """
+
+    # Whether 'scons declare' works with this executor (i.e. EUPS_PATH is the coordinator's).
+    declares = True
+
+    def __init__(self, config, jobs=1):
+        self.config = config
+        self.slots = jobs
+
+    def run(self, pkg, path, args, env=None):
+        """Run scons with the given arguments for a package, raising scons.Error on failure."""
+        if self.slots == 1:
+            scons.run(self.config, path, *args)
+        else:
+            returncode, output = scons.capture(path, args, env, fork=bool(self.config.scons.fork))
+            scons.report(self.config, path, args, returncode, output)
+
+    def close(self):
+        pass
+
+class _Connection(object):
+    """One end of a worker connection, exchanging JSON objects one per line."""
+
+    def __init__(self, rfile, wfile, process=None):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.process = process
+
+    def send(self, obj):
+        self.wfile.write(json.dumps(obj) + "\n")
+        self.wfile.flush()
+
+    def receive(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError("worker connection closed")
+        return json.loads(line)
+
+    def close(self):
+        self.wfile.close()
+        if self.process is not None:
+            self.process.wait()
+
+def token(create=False):
+    """Return the token TCP workers and their coordinators share (see above), creating the token
+    file if it doesn't exist and create is True.
+    """
+    if os.environ.get("BOT_WORKER_TOKEN"):
+        return os.environ["BOT_WORKER_TOKEN"]
+    try:
+        with open(TOKEN_FILE, "r") as file:
+            return file.read().strip()
+    except IOError as err:
+        if err.errno != errno.ENOENT or not create:
+            raise RuntimeError("Could not read worker token from '{0}' (and BOT_WORKER_TOKEN is not set): "
+                               "{1}".format(TOKEN_FILE, err))
+    if not os.path.isdir(os.path.dirname(TOKEN_FILE)):
+        os.makedirs(os.path.dirname(TOKEN_FILE), 0700)
+    value = binascii.hexlify(os.urandom(32))
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, "w") as file:
+        file.write(value + "\n")
+    logging.info("Created worker token in '{0}'.".format(TOKEN_FILE))
+    return value
+
+def connect(spec):
+    """Open a connection to a worker given a spec of the form 'HOST:PORT' (a worker started with
+    'bot worker --listen'), 'ssh://HOST' (a worker started over SSH; 'bot' must be on the remote
+    PATH), or 'local' (a worker subprocess on this machine, mostly useful for testing).
+    """
+    if spec == "local":
+        bot = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "bin", "bot"))
+        process = subprocess.Popen((sys.executable, bot, "worker", "--stdio"),
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return _Connection(process.stdout, process.stdin, process)
+    if spec.startswith("ssh://"):
+        process = subprocess.Popen(("ssh", "-T", spec[len("ssh://"):], "bot", "worker", "--stdio"),
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return _Connection(process.stdout, process.stdin, process)
+    host, sep, port = spec.rpartition(":")
+    if not sep:
+        raise ValueError("Invalid worker '{0}'; expected HOST:PORT, ssh://HOST or local".format(spec))
+    sock = socket.create_connection((host, int(port)))
+    connection = _Connection(sock.makefile("r"), sock.makefile("w"))
+    connection.send({"token": token()})
+    if not connection.receive().get("ok"):
+        raise RuntimeError("Worker '{0}' rejected our token".format(spec))
+    return connection
+
+class RemoteExecutor(object):
+    """Run scons in a pool of 'bot worker' processes, one package per worker at a time.
+    """
+
+    # The coordinator declares installed products itself, so only one process writes to the EUPS database.
+    declares = False
+
+    def __init__(self, config, specs):
+        self.config = config
+        self.connections = [connect(spec) for spec in specs]
+        self.idle = Queue.Queue()
+        for connection in self.connections:
+            self.idle.put(connection)
+        self.slots = len(self.connections)
+        self.live = len(self.connections)
+        self.lock = threading.Lock()
+
+    def _acquire(self, path, args):
+        while True:
+            with self.lock:
+                if not self.live:
+                    raise scons.Error("'{0}' in path '{1}' failed: no workers left".format(
+                        " ".join(("scons",) + tuple(args)), path))
+            try:
+                return self.idle.get(timeout=1.0)
+            except Queue.Empty:
+                pass
+
+    def run(self, pkg, path, args, env=None):
+        """Run scons with the given arguments for a package on the next free worker, raising
+        scons.Error on failure (including losing the connection to the worker, which is then
+        no longer used).
+        """
+        if env is None:
+            env = dict(os.environ)
+        connection = self._acquire(path, args)
+        try:
+            connection.send({"path": os.path.abspath(path), "args": list(args), "env": env})
+            result = connection.receive()
+        except (EOFError, IOError, socket.error, ValueError) as err:
+            with self.lock:
+                self.live -= 1
+            logging.error("Lost connection to a worker ({0}); {1} left.".format(err, self.live))
+            self._close(connection)
+            raise scons.Error("'{0}' in path '{1}' failed: lost connection to worker".format(
+                " ".join(("scons",) + tuple(args)), path))
+        self.idle.put(connection)
+        scons.report(self.config, path, args, result["returncode"], result["output"])
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except (IOError, socket.error):
+            pass
+
+    def close(self):
+        for connection in self.connections:
+            self._close(connection)
+
+def work(rfile, wfile, fork=False):
+    """Run scons requests from a coordinator until it disconnects.
+
+    If fork is True, scons is forked from a warm process (see scons.Forkserver) when possible.
+    """
+    connection = _Connection(rfile, wfile)
+    while True:
+        try:
+            request = connection.receive()
+        except EOFError:
+            return
+        logging.info("In {0}, running 'scons {1}'.".format(request["path"], " ".join(request["args"])))
+        env = dict((k.encode("utf-8"), v.encode("utf-8")) for k, v in request["env"].iteritems())
+        try:
+            returncode, output = scons.capture(request["path"], request["args"], env, fork=fork)
+        except OSError as err:
+            returncode, output = 127, "bot worker could not run scons: {0}\n".format(err)
+        connection.send({"returncode": returncode, "output": output.decode("utf-8", "replace")})
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        connection = _Connection(self.rfile, self.wfile)
+        try:
+            offered = connection.receive().get("token")
+        except (EOFError, ValueError, AttributeError):
+            offered = None
+        if not isinstance(offered, basestring) or not hmac.compare_digest(str(offered), self.server.token):
+            logging.warning("Rejected connection from {0}: bad token.".format(self.client_address[0]))
+            connection.send({"ok": False})
+            return
+        connection.send({"ok": True})
+        logging.info("Accepted connection from {0}.".format(self.client_address[0]))
+        work(self.rfile, self.wfile, fork=self.server.fork)
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def listen(host, port, fork=False):
+    """Serve scons requests on a TCP socket until interrupted, to coordinators that present the
+    worker token.
+    """
+    server = _Server((host, port), _Handler)
+    server.fork = fork
+    server.token = token(create=True)
+    host, port = server.server_address
+    logging.info("bot worker listening on {0}:{1}.".format(host, port))
+    print "{0}:{1}".format(host, port)
+    sys.stdout.flush()
+    server.serve_forever()
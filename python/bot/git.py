@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import threading
 import subprocess
 from .utils import echo
+from . import refs as refs_module
 
 class Error(RuntimeError): pass
 
@@ -14,13 +16,116 @@ def get_remotes(config, pkg):
     return {k: v.format(pkg=pkg) for k,v in d.iteritems()}
 
 def run(config, path, *args):
-    olddir = os.path.abspath(os.getcwd())
-    os.chdir(path)
     git_cmd = ("git",) + args
     echo(config.git, "In {0}, running '{1}'.".format(path, " ".join(git_cmd)))
     try:
-        subprocess.check_call(git_cmd, stderr=config.git.stderr, stdout=config.git.stdout)
+        subprocess.check_call(git_cmd, cwd=path, stderr=config.git.stderr, stdout=config.git.stdout)
     except subprocess.CalledProcessError:
         raise Error("'{0}' in path '{1}' failed".format(" ".join(git_cmd), path))
-    finally:
-        os.chdir(olddir)
+
+def local_refs(path):
+    """Return a dict of {refname: sha} for the refs in the repo at path (e.g. 'refs/heads/master').
+
+    This reads the repository files directly, which is much cheaper than running git.
+    """
+    git_dir = os.path.join(path, ".git")
+    result = {}
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), "r") as packed:
+            for line in packed:
+                words = line.split()
+                if len(words) == 2 and not line.startswith("#"):
+                    result[words[1]] = words[0]
+    except IOError:
+        pass
+    for dirpath, dirnames, filenames in os.walk(os.path.join(git_dir, "refs")):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            try:
+                with open(filename, "r") as loose:
+                    result[os.path.relpath(filename, git_dir)] = loose.read().strip()
+            except IOError:
+                pass
+    return result
+
+def has_local_ref(path, ref):
+    """Return True if the repo at path has a local branch, tag, or remote-tracking branch (in any
+    remote, which 'git checkout' can create a tracking branch from) with the given name.
+    """
+    refs = local_refs(path)
+    if "refs/heads/" + ref in refs or "refs/tags/" + ref in refs:
+        return True
+    for name in refs:
+        words = name.split("/", 3)
+        if len(words) == 4 and words[:2] == ["refs", "remotes"] and words[3] == ref:
+            return True
+    return False
+
+def fetch(config, path, branches=None, tags=None, source=None, source_remote=None):
+    """Fetch from config.git.origin into the repo at path.
+
+    If branches and tags are not None, only those branches (into remote-tracking refs) and tags are
+    fetched; otherwise everything is.  If source is not None, it is the path to another clone of
+    the same remote, and its remote-tracking refs for source_remote are fetched instead.
+    """
+    origin = config.git.origin
+    if source is None:
+        url = origin
+        branch_src = "refs/heads/{0}"
+    else:
+        url = source
+        branch_src = "refs/remotes/" + source_remote + "/{0}"
+    if branches is None and tags is None:
+        if source is None:
+            run(config, path, "fetch", origin)
+        else:
+            run(config, path, "fetch", source,
+                "+refs/remotes/{0}/*:refs/remotes/{1}/*".format(source_remote, origin), "refs/tags/*:refs/tags/*")
+        return
+    refspecs = ["+{0}:refs/remotes/{1}/{2}".format(branch_src.format(b), origin, b) for b in branches or ()]
+    refspecs.extend("+refs/tags/{0}:refs/tags/{0}".format(t) for t in tags or ())
+    run(config, path, "fetch", url, *refspecs)
+
+class FetchCache(object):
+    """Shares the results of 'git fetch' between clones of the same remote repository (i.e. the same
+    package in different stacks), so each remote is only contacted once; other clones then fetch
+    from the first clone instead, which is local and fast.
+
+    Listings of a remote's branches and tags ('git ls-remote', for the remote ref index) are shared
+    the same way: each remote is only listed once, however many stacks ask.
+
+    Safe to use from multiple threads; a clone that needs a remote another thread is already
+    fetching (or listing) waits for that to finish.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._urls = {}
+        self._listings = {}
+
+    def fetch(self, config, path, pkg, branches=None, tags=None):
+        """Fetch config.git.origin into the clone at path, as git.fetch would."""
+        url = get_remotes(config, pkg)[config.git.origin]
+        if branches is None and tags is None:
+            key = (url, None)
+        else:
+            key = (url, tuple(sorted(branches or ())), tuple(sorted(tags or ())))
+        with self._lock:
+            entry = self._urls.setdefault(key, [threading.Lock(), None])
+        with entry[0]:
+            if entry[1] is not None:
+                source, remote = entry[1]
+                fetch(config, path, branches, tags, source=source, source_remote=remote)
+            else:
+                fetch(config, path, branches, tags)
+                entry[1] = (os.path.abspath(path), config.git.origin)
+
+    def ls_remote(self, url):
+        """Return refs.ls_remote(url), listing each remote only once."""
+        with self._lock:
+            entry = self._listings.setdefault(url, [threading.Lock(), None, False])
+        with entry[0]:
+            if not entry[2]:
+                entry[1] = refs_module.ls_remote(url)
+                entry[2] = True
+            return entry[1]
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Durations of past scons runs, and the critical-path estimates derived from them.
+"""
+
+import json
+import heapq
+import logging
+import threading
+
+from . import lock as locking
+from .utils import atomic_write
+
+__all__ = "History", "critical_paths", "simulate"
+
+class History(object):
+    """Recent durations (in seconds) of each package's scons runs, stored as JSON in a small file.
+
+    Durations are kept separately for each kind of run ("build", "install", ...), since they
+    can differ a lot for the same package.
+
+    The file may be shared by several stacks (and bot processes), so save() merges the runs
+    recorded here into whatever is on disk at the time, rather than overwriting it.
+    """
+
+    # Number of recent runs averaged to estimate the next one.
+    keep = 5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.data = self._read()
+        self.new = {}
+
+    def _read(self):
+        try:
+            with open(self.filename, "r") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def record(self, kind, pkg, duration):
+        """Add the duration of a successful run."""
+        with self.lock:
+            runs = self.data.setdefault(kind, {}).setdefault(pkg, [])
+            runs.append(duration)
+            del runs[:-self.keep]
+            self.new.setdefault(kind, {}).setdefault(pkg, []).append(duration)
+
+    def durations(self, kind, packages):
+        """Return a dict of estimated durations for the given packages.
+
+        Packages without any history are assigned the mean of the others (or one second, if
+        there is no history at all).
+        """
+        runs = self.data.get(kind, {})
+        result = dict((pkg, sum(runs[pkg]) / len(runs[pkg])) for pkg in packages if runs.get(pkg))
+        default = sum(result.itervalues()) / len(result) if result else 1.0
+        for pkg in packages:
+            result.setdefault(pkg, default)
+        return result
+
+    def save(self):
+        """Add the runs recorded since the last save to the history file, atomically replacing it."""
+        with self.lock:
+            if not self.new:
+                return
+            try:
+                with locking.Lock(self.filename + ".lock"):
+                    data = self._read()
+                    for kind, packages in self.new.iteritems():
+                        for pkg, durations in packages.iteritems():
+                            runs = data.setdefault(kind, {}).setdefault(pkg, [])
+                            runs.extend(durations)
+                            del runs[:-self.keep]
+                    with atomic_write(self.filename) as output:
+                        json.dump(data, output, indent=1, sort_keys=True)
+            except (IOError, OSError) as err:
+                logging.warning("Could not save build history to '{0}': {1}".format(self.filename, err))
+                return
+            self.data = data
+            self.new = {}
+
+def _dependents(packages, dependencies):
+    result = dict((pkg, []) for pkg in packages)
+    for pkg in packages:
+        for dep in dependencies.get(pkg, ()):
+            if dep in result:
+                result[dep].append(pkg)
+    return result
+
+def critical_paths(packages, dependencies, durations):
+    """Return a dict of the time from starting each package to finishing everything that depends on
+    it, if there were no limit on the number of packages built at once.
+
+    packages must be in dependency order.
+    """
+    dependents = _dependents(packages, dependencies)
+    result = {}
+    for pkg in reversed(packages):
+        result[pkg] = durations[pkg] + max([result[d] for d in dependents[pkg]] or [0.0])
+    return result
+
+def critical_path(packages, dependencies, durations):
+    """Return the longest chain of dependent packages, as a list of package names."""
+    remaining = critical_paths(packages, dependencies, durations)
+    dependents = _dependents(packages, dependencies)
+    candidates = [pkg for pkg in packages if not set(dependencies.get(pkg, ())) & set(packages)]
+    result = []
+    while candidates:
+        pkg = max(candidates, key=remaining.get)
+        result.append(pkg)
+        candidates = dependents[pkg]
+    return result
+
+def simulate(packages, dependencies, durations, slots, priority=None):
+    """Return the predicted wall time for running the given packages in up to 'slots' at once, with
+    ready packages started in order of decreasing priority (or in the order of 'packages').
+    """
+    order = dict((pkg, i) for i, pkg in enumerate(packages))
+    if priority is None:
+        key = order.get
+    else:
+        key = lambda pkg: (-priority[pkg], order[pkg])
+    waiting = dict((pkg, set(dependencies.get(pkg, ())) & set(order)) for pkg in packages)
+    dependents = _dependents(packages, dependencies)
+    ready = sorted((pkg for pkg, deps in waiting.iteritems() if not deps), key=key)
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < slots:
+            pkg = ready.pop(0)
+            heapq.heappush(running, (now + durations[pkg], pkg))
+        now, pkg = heapq.heappop(running)
+        for dependent in dependents[pkg]:
+            waiting[dependent].discard(pkg)
+            if not waiting[dependent]:
+                ready.append(dependent)
+        ready.sort(key=key)
+    return now
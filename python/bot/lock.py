@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Advisory locks (with flock) that let several bot processes work on the same stacks at once.
+
+Each stack has a lock file, '.bot.lock' in its root directory: commands that only read the stack's
+files (list, build, ...) hold it shared, while commands that rewrite them (sync, declare, ...) hold
+it exclusively.  A stack that inherits from another also holds a shared lock on its base, so the
+base can't be synced out from under it.
+
+Each package also has a lock file, '.locks/PKG.lock' in the root of the stack it lives in, held
+exclusively while git or scons runs in it; this lets independent commands share a stack (and
+child stacks share inherited packages) without running two things in one repo at once.
+
+Locks are advisory: they only exclude other bot processes.  Stacks on filesystems we can't write
+to (e.g. a shared, read-only base stack) aren't locked at all.
+"""
+
+import os
+import errno
+import fcntl
+import logging
+
+__all__ = "SHARED", "EXCLUSIVE", "Lock", "stack", "package"
+
+SHARED = fcntl.LOCK_SH
+EXCLUSIVE = fcntl.LOCK_EX
+
+_names = {SHARED: "shared", EXCLUSIVE: "exclusive"}
+
+class Lock(object):
+    """A shared or exclusive lock on a file, usable as a context manager."""
+
+    def __init__(self, filename, mode=EXCLUSIVE):
+        self.filename = filename
+        self.mode = mode
+        self.file = None
+
+    def acquire(self):
+        """Wait for and take the lock; returns self."""
+        try:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = open(self.filename, "a")
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EACCES, errno.EPERM, errno.EROFS):
+                raise
+            logging.debug("Not locking '{0}': {1}".format(self.filename, err))
+            return self
+        try:
+            fcntl.flock(self.file.fileno(), self.mode | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logging.info("Waiting for {0} lock on '{1}'...".format(_names[self.mode], self.filename))
+            fcntl.flock(self.file.fileno(), self.mode)
+        return self
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+def stack(path, mode=SHARED):
+    """Return the (not yet acquired) Lock for the stack rooted at path."""
+    return Lock(os.path.join(path, ".bot.lock"), mode)
+
+def package(path, mode=EXCLUSIVE):
+    """Return the (not yet acquired) Lock for the package whose source directory is path."""
+    directory, name = os.path.split(os.path.normpath(path))
+    return Lock(os.path.join(directory, ".locks", "{0}.lock".format(name)), mode)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""A cached index of the branches and tags in remote git repositories, built with one
+'git ls-remote' per repository.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import subprocess
+import multiprocessing.pool
+
+from . import lock as locking
+from .utils import atomic_write
+
+__all__ = "RefIndex",
+
+_sha = re.compile(r"^[0-9a-f]{7,40}$")
+
+def ls_remote(url):
+    """Return ({branch: sha}, {tag: sha}) for a remote repository, or None if it can't be reached."""
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(("git", "ls-remote", "--heads", "--tags", url),
+                                   stdout=subprocess.PIPE, stderr=devnull)
+        output, unused = process.communicate()
+    if process.returncode != 0:
+        return None
+    heads = {}
+    tags = {}
+    for line in output.splitlines():
+        sha, name = line.split("\t", 1)
+        if name.startswith("refs/heads/"):
+            heads[name[len("refs/heads/"):]] = sha
+        elif name.startswith("refs/tags/"):
+            name = name[len("refs/tags/"):]
+            if name.endswith("^{}"):
+                tags[name[:-3]] = sha  # peeled annotated tags point at the commit we want
+            else:
+                tags.setdefault(name, sha)
+    return heads, tags
+
+class RefIndex(object):
+    """Branches and tags of remote repositories, keyed by URL and cached in a JSON file.
+
+    Entries older than ttl seconds are refreshed (concurrently) when requested, by calling
+    lister(url) (ls_remote, or e.g. git.FetchCache.ls_remote to share listings between stacks).  The cache file
+    may be shared by several stacks, so save() keeps whichever of its entries and ours is newer.
+    """
+
+    def __init__(self, filename, ttl=600, jobs=8, lister=ls_remote):
+        self.filename = filename
+        self.ttl = ttl
+        self.jobs = jobs
+        self.lister = lister
+        self.lock = threading.Lock()
+        self.data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.filename, "r") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def _fresh(self, url):
+        entry = self.data.get(url)
+        return entry is not None and time.time() - entry["time"] < self.ttl
+
+    def _update(self, url):
+        result = self.lister(url)
+        with self.lock:
+            if result is None:
+                # remember the failure too, so we don't keep retrying an unreachable remote
+                logging.info("Could not list refs in '{0}'.".format(url))
+                self.data[url] = {"time": time.time(), "heads": None, "tags": None}
+            else:
+                self.data[url] = {"time": time.time(), "heads": result[0], "tags": result[1]}
+
+    def refresh(self, urls, force=False):
+        """Update the entries for the given URLs (only those that are stale, unless force)."""
+        stale = sorted(set(url for url in urls if force or not self._fresh(url)))
+        if not stale:
+            return
+        logging.info("Listing refs in {0} remote repositories.".format(len(stale)))
+        pool = multiprocessing.pool.ThreadPool(max(1, min(self.jobs, len(stale))))
+        try:
+            pool.map(self._update, stale)
+        finally:
+            pool.close()
+        self.save()
+
+    def find(self, url, ref):
+        """Return ("heads", sha) or ("tags", sha) if the remote has a branch or tag with the given
+        name, False if the remote is known not to have it, or None if we can't tell (e.g. ref is
+        a SHA, or the remote is unreachable).
+        """
+        if not self._fresh(url):
+            self.refresh([url])
+        entry = self.data.get(url)
+        if entry is None or entry["heads"] is None or _sha.match(ref):
+            return None
+        for kind in ("heads", "tags"):
+            if ref in entry[kind]:
+                return kind, entry[kind][ref]
+        return False
+
+    def lookup(self, url, ref):
+        """Return the SHA the given branch or tag points to in the remote, False if the remote is
+        known not to have it, or None if we can't tell (e.g. ref is a SHA, or the remote is unreachable).
+        """
+        found = self.find(url, ref)
+        return found[1] if found else found
+
+    def save(self):
+        """Merge our entries into the cache file, atomically replacing it."""
+        with self.lock:
+            try:
+                with locking.Lock(self.filename + ".lock"):
+                    data = self._read()
+                    for url, entry in self.data.iteritems():
+                        if url not in data or data[url]["time"] < entry["time"]:
+                            data[url] = entry
+                    with atomic_write(self.filename) as output:
+                        json.dump(data, output)
+            except (IOError, OSError) as err:
+                logging.warning("Could not save ref index to '{0}': {1}".format(self.filename, err))
+                return
+            self.data = data
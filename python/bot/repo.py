@@ -4,29 +4,67 @@ from . import git
 from . import eups
 from . import scons
 from . import config
+from . import executor as executor_module
+from . import history
+from . import report
+from . import lock
+from . import refs as refs_module
+from .utils import atomic_write
 
 import os
 import sys
+import ast
+import time
+import pipes
 import shutil
 import logging
 
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{0}m{1:02d}s".format(minutes, seconds)
+    return "{0}s".format(seconds)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 class RepoSet(object):
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, bases=None):
+        """Construct from a loaded config.
+
+        If bases is not None, it is a dict of {absolute path: RepoSet} used to share base RepoSets
+        between several RepoSets that inherit from the same stack; new bases are added to it.
+        """
         self.config = cfg
         self.packages = None
         self.refs = None
         self.external = None
         self.inherited = None
+        self.dependencies = None
+        self.ref_index = None
+        self._refreshed = set()
         if self.config.packages.inherit.base:
             base_path = os.path.normpath(os.path.join(self.config.path, self.config.packages.inherit.base))
-            base_config = config.load(base_path)
-            self.base = RepoSet(base_config)
-            try:
-                self.base.read_list()
-            except RuntimeError:
-                raise RuntimeError("Please run 'bot sync' on the base repo at '{path}'"
-                                   .format(path=base_path))
+            key = os.path.abspath(base_path)
+            if bases is not None and key in bases:
+                self.base = bases[key]
+            else:
+                base_config = config.load(base_path)
+                self.base = RepoSet(base_config, bases=bases)
+                try:
+                    self.base.read_list()
+                except RuntimeError:
+                    raise RuntimeError("Please run 'bot sync' on the base repo at '{path}'"
+                                       .format(path=base_path))
+                if bases is not None:
+                    bases[key] = self.base
         else:
             self.base = None
 
@@ -46,6 +84,19 @@ class RepoSet(object):
         else:
             return self.config.eups.version(ref=self.refs[pkg], eups=self.config.eups)
 
+    def lock(self, mode=lock.SHARED):
+        """Wait for and return the locks needed to work on this repo set: its own stack lock with
+        the given mode, and shared locks on the stacks it inherits from (see lock.py).
+
+        The locks are held until released (or bot exits).
+        """
+        held = []
+        repos = self
+        while repos is not None:
+            held.append(lock.stack(repos.config.path, mode if repos is self else lock.SHARED).acquire())
+            repos = repos.base
+        return held
+
     def write_table(self):
         """Write the EUPS table file for the metapackage."""
         assert self.packages is not None
@@ -55,7 +106,7 @@ class RepoSet(object):
         ups = os.path.join(self.config.path, "ups")
         if not os.path.exists(ups): os.makedirs(ups)
         meta = self.config.eups.meta.format(eups=self.config.eups)
-        with open(os.path.join(ups, "{0}.table".format(meta)), "w") as file:
+        with atomic_write(os.path.join(ups, "{0}.table".format(meta))) as file:
             for pkg, required in self.external.iteritems():
                 if required:
                     file.write("setupRequired({pkg})\n".format(pkg=pkg))
@@ -64,13 +115,72 @@ class RepoSet(object):
             for pkg in self.packages:
                 file.write("setupRequired({pkg} -j {version})\n".format(pkg=pkg, version=self.version(pkg)))
 
+    def _environment_files(self):
+        meta = self.config.eups.meta.format(eups=self.config.eups)
+        ups = os.path.join(self.config.path, "ups")
+        return meta, os.path.join(ups, "{0}.env.sh".format(meta)), os.path.join(ups, "{0}.env.py".format(meta))
+
+    def write_environment(self):
+        """Setup the metapackage once and save the resulting environment as a sourceable shell script
+        and a Python dict, along with the modification times of every table file and EUPS declaration
+        it depends on.
+        """
+        meta, sh_file, py_file = self._environment_files()
+        logging.info("Computing environment for '{meta}'.".format(meta=meta))
+        changes = eups.environment(self.config.path, meta)
+        watched = [os.path.join(self.config.path, "ups", "{0}.table".format(meta))]
+        for name, (action, value) in changes.iteritems():
+            if name.startswith("SETUP_") and value:
+                product = value.split()[0]
+                directory = changes.get("{0}_DIR".format(product.upper()), (None, None))[1]
+                if directory is not None:
+                    watched.append(os.path.join(directory, "ups", "{0}.table".format(product)))
+                watched.extend(eups.declaration_files(product))
+        stamp = dict((f, _mtime(f)) for f in watched)
+        with atomic_write(sh_file) as file:
+            for name, (action, value) in sorted(changes.iteritems()):
+                if action == "unset":
+                    file.write("unset {name}\n".format(name=name))
+                elif action == "prepend":
+                    file.write('export {name}={value}"${{{name}:+:${name}}}"\n'.format(
+                        name=name, value=pipes.quote(value)))
+                else:
+                    file.write("export {name}={value}\n".format(name=name, value=pipes.quote(value)))
+        with atomic_write(py_file) as file:
+            file.write(repr({"environment": changes, "stamp": stamp}))
+
+    def read_environment(self):
+        """Return the environment changes saved by write_environment, as a dict of
+        {name: (action, value)}, or None if there is no snapshot or it is out of date.
+        """
+        meta, sh_file, py_file = self._environment_files()
+        try:
+            with open(py_file, "r") as file:
+                snapshot = ast.literal_eval(file.read())
+        except (IOError, SyntaxError, ValueError):
+            return None
+        for f, mtime in snapshot["stamp"].iteritems():
+            if _mtime(f) != mtime:
+                logging.info("'{f}' has changed; environment snapshot is out of date.".format(f=f))
+                return None
+        return snapshot["environment"]
+
+    def env(self):
+        """Print the path to a shell script that activates the metapackage environment
+        (use as 'source $(bot env)'), recomputing it first if any table file or declaration has changed.
+        """
+        meta, sh_file, py_file = self._environment_files()
+        if self.read_environment() is None:
+            self.write_environment()
+        print sh_file
+
     def write_list(self):
         """Write a text file containing a dependency sorted list with package name and version columns.
         """
         assert self.packages is not None
         assert self.refs is not None
         assert self.inherited is not None
-        with open(os.path.join(self.config.path, "packages"), "w") as file:
+        with atomic_write(os.path.join(self.config.path, "packages")) as file:
             for pkg in self.packages:
                 if pkg in self.inherited:
                     file.write("{pkg} [{ref}]\n".format(pkg=pkg, ref=self.refs[pkg]))
@@ -96,6 +206,79 @@ class RepoSet(object):
         except IOError as err:
             raise RuntimeError("packages file not found - repo set is not synced or path not given")
 
+    def _ref_index(self, fetcher=None):
+        """Return the RefIndex for remote branches and tags, or None if it is disabled.
+
+        If fetcher (a git.FetchCache) is given, remotes it has already listed aren't listed again.
+        """
+        if not self.config.git.refs.cache:
+            return None
+        lister = fetcher.ls_remote if fetcher is not None else refs_module.ls_remote
+        return refs_module.RefIndex(self.config.git.refs.cache, ttl=self.config.git.refs.ttl or 0,
+                                    lister=lister)
+
+    def _origin_url(self, pkg):
+        return git.get_remotes(self.config, pkg)[self.config.git.origin]
+
+    def find_ref(self, ref, refresh=False):
+        """Print the managed packages whose origin remote has the given branch or tag, using the
+        cached index of remote refs.
+        """
+        assert self.packages is not None
+        assert self.refs is not None
+        index = self._ref_index()
+        if index is None:
+            raise RuntimeError("The remote ref index is disabled (git.refs.cache is not set)")
+        urls = dict((pkg, self._origin_url(pkg)) for pkg in self.packages if self.refs[pkg] is not None)
+        index.refresh(urls.values(), force=refresh)
+        for pkg in self.packages:
+            if pkg in urls and index.lookup(urls[pkg], ref):
+                print pkg
+
+    def write_dependencies(self):
+        """Write a text file containing each managed package followed by its immediate managed dependencies.
+        """
+        assert self.packages is not None
+        assert self.dependencies is not None
+        with atomic_write(os.path.join(self.config.path, "dependencies")) as file:
+            for pkg in self.packages:
+                file.write(" ".join([pkg] + sorted(self.dependencies[pkg])) + "\n")
+
+    def read_dependencies(self):
+        """Read the dependency graph written by the last sync.
+
+        If the dependencies file is missing (i.e. the repo set was synced by an older version of
+        bot), the graph is reconstructed from the table files of the packages in the list.
+        """
+        assert self.packages is not None
+        self.dependencies = {}
+        try:
+            with open(os.path.join(self.config.path, "dependencies"), "r") as file:
+                for line in file:
+                    words = line.split()
+                    self.dependencies[words[0]] = set(words[1:])
+        except IOError:
+            logging.info("dependencies file not found; reading table files instead.")
+            managed = set(self.packages)
+            for pkg in self.packages:
+                self.dependencies[pkg] = set(
+                    dependency for dependency, optional in eups.get_dependencies(self.config, self.path(pkg),
+                                                                                  pkg, recursive=False)
+                    if dependency in managed
+                )
+
+    def dependents(self, pkgs):
+        """Return the given packages and all managed packages that depend on them, directly or
+        indirectly, in dependency order.
+        """
+        assert self.packages is not None
+        assert self.dependencies is not None
+        affected = set(pkgs)
+        for pkg in self.packages:
+            if self.dependencies.get(pkg, set()) & affected:
+                affected.add(pkg)
+        return [pkg for pkg in self.packages if pkg in affected]
+
     def declare(self):
         """Declare all managed packages with EUPS."""
         assert self.packages is not None
@@ -130,23 +313,140 @@ class RepoSet(object):
         for pkg in self.packages:
             print pkg
 
+    def _selected(self, **kw):
+        """Return the packages processed by batch operations: managed packages, and inherited ones
+        if kw["inherited"].
+
+        If kw["shard"] is (i, n), only every n-th of those packages (in dependency order) starting
+        with the i-th (counting from 1) is returned, so n invocations together cover all of them.
+        """
+        result = [pkg for pkg in self.packages if pkg not in self.inherited or kw.get("inherited")]
+        shard = kw.get("shard")
+        if shard:
+            index, count = shard
+            result = result[index - 1::count]
+        return result
+
+    def _history(self):
+        """Return the History of scons run durations, or None if it is disabled."""
+        if not self.config.scons.history:
+            return None
+        return history.History(self.config.scons.history)
+
+    def _batch(self, kind, func, **kw):
+        """Call func(pkg) for each selected package in dependency order, with up to executor.slots
+        calls running at once.
+
+        func should return True on success; the durations of successful calls are recorded in
+        the history under the given kind, and used to start the packages on the longest remaining
+        chain of dependents first.
+        """
+        executor = kw.get("executor")
+        slots = executor.slots if executor is not None else 1
+        selected = self._selected(**kw)
+        for pkg in self.packages:
+            if pkg in self.inherited and not kw.get("inherited"):
+                logging.info("Skipping inherited package '{pkg}'...".format(pkg=pkg))
+            elif pkg not in selected:
+                logging.info("Skipping package '{pkg}' in another shard...".format(pkg=pkg))
+        hist = self._history()
+        priority = None
+        if hist is not None and slots > 1 and self.dependencies is not None:
+            priority = history.critical_paths(selected, self.dependencies, hist.durations(kind, selected))
+
+        def timed(pkg):
+            with lock.package(self.path(pkg)):
+                start = time.time()
+                if func(pkg) and hist is not None:
+                    hist.record(kind, pkg, time.time() - start)
+
+        try:
+            executor_module.schedule(selected, self.dependencies, timed, slots=slots, priority=priority)
+        finally:
+            if hist is not None:
+                hist.save()
+
+    def estimate(self, slots=1, kind="build", **kw):
+        """Print the predicted wall time for building all managed packages with up to 'slots' at once,
+        based on the durations of previous builds, along with the critical path.
+        """
+        assert self.packages is not None
+        assert self.inherited is not None
+        assert self.dependencies is not None
+        hist = self._history()
+        if hist is None:
+            raise RuntimeError("Build history is disabled (scons.history is not set)")
+        selected = self._selected(**kw)
+        durations = hist.durations(kind, selected)
+        priority = history.critical_paths(selected, self.dependencies, durations)
+        print "Estimated wall time with {0} at once: {1} ({2} in dependency order, {3} serially)".format(
+            slots, _format_duration(history.simulate(selected, self.dependencies, durations, slots, priority)),
+            _format_duration(history.simulate(selected, self.dependencies, durations, slots)),
+            _format_duration(sum(durations.itervalues())))
+        print "Critical path:"
+        for pkg in history.critical_path(selected, self.dependencies, durations):
+            print "  {0:<32} {1:>10}".format(pkg, _format_duration(durations[pkg]))
+        unknown = [pkg for pkg in selected if not hist.data.get(kind, {}).get(pkg)]
+        if unknown:
+            print "{0} package(s) have no history and were assumed to take {1}.".format(
+                len(unknown), _format_duration(durations[unknown[0]]))
+
     def build(self, *args, **kw):
         """Build all managed packages with scons.  They must already be setup.
         """
         assert self.packages is not None
         assert self.inherited is not None
-        for pkg in self.packages:
-            if pkg not in self.inherited or kw.get("inherited"):
-                logging.info("Building '{pkg}'...".format(pkg=pkg))
-                try:
-                    scons.run(self.config, self.path(pkg), *args)
-                except scons.Error as err:
-                    if kw.get("ignore_failed"):
-                        logging.warning("Build for '{pkg}' failed; continuing...".format(pkg=pkg))
-                        continue
-                    raise err
+        executor = kw.get("executor") or executor_module.LocalExecutor(self.config)
+
+        def build_one(pkg):
+            logging.info("Building '{pkg}'...".format(pkg=pkg))
+            try:
+                executor.run(pkg, self.path(pkg), args)
+            except scons.Error as err:
+                if kw.get("ignore_failed"):
+                    logging.warning("Build for '{pkg}' failed; continuing...".format(pkg=pkg))
+                    return False
+                raise err
+            return True
+
+        self._batch("build", build_one, **kw)
+
+    def test(self, *args, **kw):
+        """Run 'scons tests' for all managed packages (they must already be setup and built), and
+        return a list of per-package results (see report.py).
+
+        A failure in one package doesn't stop the others from being tested.
+        """
+        assert self.packages is not None
+        assert self.inherited is not None
+        executor = kw.get("executor") or executor_module.LocalExecutor(self.config)
+        results = {}
+
+        def test_one(pkg):
+            logging.info("Testing '{pkg}'...".format(pkg=pkg))
+            path = self.path(pkg)
+            report.clear(path)
+            start = time.time()
+            try:
+                executor.run(pkg, path, ("tests",) + args)
+                ok = True
+            except scons.Error:
+                ok = False
+            passed, failed = report.collect(path)
+            if failed:
+                status = "failed"
+            elif ok:
+                status = "passed"
             else:
-                logging.info("Skipping inherited package '{pkg}'...".format(pkg=pkg))
+                status = "error"
+            if status != "passed":
+                logging.warning("Tests for '{pkg}' failed; continuing...".format(pkg=pkg))
+            results[pkg] = {"package": pkg, "status": status, "duration": time.time() - start,
+                            "passed": passed, "failed": failed}
+            return ok
+
+        self._batch("test", test_one, **kw)
+        return [results[pkg] for pkg in self._selected(**kw) if pkg in results]
 
     def run_git(self, *args, **kw):
         """Run the same git command on each package, excluding 'manual' packages.
@@ -162,7 +462,8 @@ class RepoSet(object):
                 logging.info("Processing '{pkg}'...".format(pkg=pkg))
                 expanded = [arg.format(pkg=pkg, ref=ref) for arg in args]
                 try:
-                    git.run(self.config, self.path(pkg), *expanded)
+                    with lock.package(self.path(pkg)):
+                        git.run(self.config, self.path(pkg), *expanded)
                 except git.Error as err:
                     if kw.get("ignore_failed"):
                         logging.info("Failure on '{pkg}'; continuing...".format(pkg=pkg))
@@ -176,29 +477,41 @@ class RepoSet(object):
         """
         assert self.packages is not None
         assert self.inherited is not None
+        executor = kw.get("executor") or executor_module.LocalExecutor(self.config)
         to_tag = []
-        for pkg in self.packages:
-            if pkg not in self.inherited or kw.get("inherited"):
-                version = kw["version"].format(pkg=pkg)
-                full_args = args + ("install", "declare", "version=" + version)
-                logging.info("Installing '{pkg}'...".format(pkg=pkg))
-                try:
-                    scons.run(self.config, self.path(pkg), *full_args)
-                    eups.setup(pkg, version, nodepend=True)
-                    to_tag.append((pkg, version))
-                except scons.Error as err:
-                    if kw.get("ignore_failed"):
-                        logging.warning("Build for '{pkg}' failed; continuing...".format(pkg=pkg))
-                        continue
-                    raise err
-            else:
-                logging.warn("Skipping inherited package '{pkg}'...".format(pkg=pkg))
+
+        def install_one(pkg):
+            version = kw["version"].format(pkg=pkg)
+            full_args = args + ("install", "version=" + version)
+            if executor.declares:
+                full_args += ("declare",)
+            logging.info("Installing '{pkg}'...".format(pkg=pkg))
+            with eups.lock:
+                env = dict(os.environ)
+            try:
+                executor.run(pkg, self.path(pkg), full_args, env=env)
+            except scons.Error as err:
+                if kw.get("ignore_failed"):
+                    logging.warning("Build for '{pkg}' failed; continuing...".format(pkg=pkg))
+                    return False
+                raise err
+            with eups.lock:
+                if not executor.declares:
+                    eups.declare_installed(pkg, version)
+                eups.setup(pkg, version, nodepend=True)
+                to_tag.append((pkg, version))
+            return True
+
+        self._batch("install", install_one, **kw)
         tag = kw.get("tag")
         if tag:
+            if executor.declares:
+                eups.reset()  # 'scons declare' changed the EUPS database behind our handle's back
             for pkg, version in to_tag:
                 eups.tag(pkg, version, tag)
 
-    def sync(self, fetch=False, declare=True, write_table=True, write_list=True, manual_are_new=False):
+    def sync(self, fetch=False, declare=True, write_table=True, write_list=True, manual_are_new=False,
+             fetcher=None):
         """Clone and/or checkout git repositories to match the package list defined
         by the configuration, and declare them to EUPS and write the
         EUPS metapackage table file.
@@ -210,6 +523,9 @@ class RepoSet(object):
         If manual_are_new, git repos already found in the directory will be treated as if they were
         just cloned: they will have their remotes updated, and may be deleted if it is determined
         they can be inherited.
+
+        If fetcher is not None, it should be a git.FetchCache used to share fetches (and listings of
+        remote refs) with other RepoSets being synced at the same time.
         """
         allExternal = set(self.config.packages.external)
         if isinstance(self.config.packages.top, basestring):
@@ -223,13 +539,35 @@ class RepoSet(object):
         self.inherited = set()
         new_clones = set()
         dependencies = {}
+        # The remote ref index is only needed to choose among several default refs, or to decide what
+        # to fetch; otherwise syncing existing clones shouldn't need the network at all.
+        self.ref_index = None
+        if fetch or len(self.config.packages.refs.default) > 1:
+            self.ref_index = self._ref_index(fetcher)
+        self._refreshed = set()
+        if self.ref_index is not None:
+            # list the refs of every remote we expect to need up front (concurrently), so we can skip
+            # default refs that don't exist without trying to check them out
+            known = set(todo)
+            try:
+                with open(os.path.join(self.config.path, "packages"), "r") as file:
+                    known.update(line.split()[0] for line in file if line.strip())
+            except IOError:
+                pass
+            known.update(self.config.packages.refs.overrides.iterkeys())
+            # when fetching, always list the remote refs again: they tell us what needs fetching
+            self._refresh_refs(known, force=fetch)
         while todo:
             pkg = todo.pop(0)
             if pkg in done:
                 continue
             done.add(pkg)
+            if self.ref_index is not None:
+                # list the refs of newly-discovered dependencies a level at a time, before cloning them
+                # (and, as above, list them again when fetching, even if the cache entries are recent)
+                self._refresh_refs([pkg] + [p for p in todo if p not in done], force=fetch)
             # clone or fetch the git repo as needed
-            if not self._ensure_repo(pkg, fetch, new_clones, manual_are_new=manual_are_new):
+            if not self._ensure_repo(pkg, fetch, new_clones, manual_are_new=manual_are_new, fetcher=fetcher):
                 if pkg in dependencies:
                     del dependencies[pkg]
                 for deps in dependencies.itervalues():
@@ -267,6 +605,8 @@ class RepoSet(object):
                 break
             self.inherited -= uninheritable
         # use the dependency dict-of-sets to make a dependency-sorted list of managed packages
+        # (keeping a copy, because sorting consumes it)
+        self.dependencies = dict((pkg, set(deps)) for pkg, deps in dependencies.iteritems())
         self.packages = self._make_sorted_list(dependencies)
         # go through all the packages, and add repos for things we thought we could inherit but can't
         for pkg in self.packages:
@@ -293,9 +633,16 @@ class RepoSet(object):
         # other optional tasks
         if declare: self.declare()
         if write_table: self.write_table()
-        if write_list: self.write_list()
+        if declare and write_table:
+            try:
+                self.write_environment()
+            except Exception as err:
+                logging.warning("Could not compute metapackage environment: {0}".format(err))
+        if write_list:
+            self.write_list()
+            self.write_dependencies()
 
-    def _ensure_repo(self, pkg, fetch, new_clones, inherit=True, manual_are_new=False):
+    def _ensure_repo(self, pkg, fetch, new_clones, inherit=True, manual_are_new=False, fetcher=None):
         """Worker function for sync - clones a git repo as needed and optionally fetches
         new changes from the origin remote if one is already present.
         """
@@ -305,8 +652,15 @@ class RepoSet(object):
                 if self.config.packages.refs.overrides.get(pkg, False) is None:
                     logging.info("Not fetching manual package '{pkg}'".format(pkg=pkg))
                 else:
-                    logging.info("Fetching (but not merging) from git '{pkg}'.".format(pkg=pkg))
-                    git.run(self.config, self.path(pkg), "fetch", self.config.git.origin)
+                    branches, tags = self._fetch_refs(pkg)
+                    if branches is not None and not branches and not tags:
+                        logging.info("Refs for '{pkg}' are up to date; not fetching.".format(pkg=pkg))
+                    else:
+                        logging.info("Fetching (but not merging) from git '{pkg}'.".format(pkg=pkg))
+                        if fetcher is not None:
+                            fetcher.fetch(self.config, self.path(pkg), pkg, branches, tags)
+                        else:
+                            git.fetch(self.config, self.path(pkg), branches, tags)
             if manual_are_new:
                 new_clones.add(pkg)
         else:
@@ -344,6 +698,46 @@ class RepoSet(object):
                     return False
         return True
 
+    def _refresh_refs(self, pkgs, force):
+        """Worker function for sync - update the remote ref index entries of the given packages that
+        haven't already been updated in this sync, concurrently.
+        """
+        urls = set(self._origin_url(pkg) for pkg in pkgs
+                   if self.config.packages.refs.overrides.get(pkg, False) is not None)
+        urls -= self._refreshed
+        if urls:
+            self.ref_index.refresh(urls, force=force)
+            self._refreshed |= urls
+
+    def _fetch_refs(self, pkg):
+        """Worker function for _ensure_repo - returns (branches, tags) that need to be fetched for a
+        package: just the refs sync may check out (the override, or the defaults), and only those
+        whose value in the remote differs from our copy.  Returns (None, None) if we can't tell
+        (no remote ref index, or a ref that isn't a branch or tag), meaning everything should be fetched.
+        """
+        if self.ref_index is None:
+            return None, None
+        override = self.config.packages.refs.overrides.get(pkg, False)
+        wanted = [override] if override else list(self.config.packages.refs.default)
+        url = self._origin_url(pkg)
+        self._refresh_refs([pkg], force=True)  # a no-op unless sync somehow hasn't done it yet
+        local = git.local_refs(self.path(pkg))
+        branches = []
+        tags = []
+        for ref in wanted:
+            found = self.ref_index.find(url, ref)
+            if found is None:
+                return None, None
+            if found is False:
+                continue
+            kind, sha = found
+            if kind == "heads":
+                if local.get("refs/remotes/{0}/{1}".format(self.config.git.origin, ref)) != sha:
+                    branches.append(ref)
+            elif "refs/tags/" + ref not in local:
+                tags.append(ref)
+        return branches, tags
+
     def _checkout_ref(self, pkg, inherit=True):
         """Worker function for sync - checks out the first available ref from config.packages.refs
         for a single package.
@@ -357,7 +751,7 @@ class RepoSet(object):
             logging.debug("Trying to checkout ref '{ref}' for '{pkg}'.".format(ref=ref, pkg=pkg))
             git.run(self.config, self.path(pkg), "checkout", ref)
         elif ref is False:  # don't want to match 'ref is None' here
-            for ref in self.config.packages.refs.default:
+            for ref in self._candidate_refs(pkg):
                 trueref = ref
                 logging.debug("Trying to checkout ref '{ref}' for '{pkg}'.".format(ref=ref, pkg=pkg))
                 try:
@@ -383,6 +777,23 @@ class RepoSet(object):
                 logging.info("'{pkg}' could not be found in the base repo.".format(pkg=pkg))    
         return ref
 
+    def _candidate_refs(self, pkg):
+        """Worker function for _checkout_ref - returns the refs in config.packages.refs.default that
+        may exist for a package, skipping those that the remote ref index says the origin remote
+        doesn't have (unless they exist locally).
+        """
+        candidates = list(self.config.packages.refs.default)
+        if self.ref_index is None or len(candidates) < 2:
+            return candidates
+        url = self._origin_url(pkg)
+        result = []
+        for ref in candidates:
+            if self.ref_index.lookup(url, ref) is False and not git.has_local_ref(self.path(pkg), ref):
+                logging.debug("Ref '{ref}' does not exist for '{pkg}'; skipping.".format(ref=ref, pkg=pkg))
+            else:
+                result.append(ref)
+        return result
+
     def _make_sorted_list(self, data):
         """Given a dict of package names and sets of immediate dependencies, generate
         a dependency-sorted list of package names.
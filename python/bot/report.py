@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Aggregated results of 'bot test', written as JUnit XML or JSON.
+
+Results are a list of dicts, one per package in the order they were run, with keys:
+
+  package   - package name
+  status    - "passed", "failed" (some tests failed) or "error" (scons failed without any failed tests)
+  duration  - wall time of 'scons tests' for the package, in seconds
+  passed    - names of tests that passed
+  failed    - list of {"name": ..., "output": ...} for tests that failed
+"""
+
+import os
+import json
+import shutil
+import xml.etree.ElementTree as ElementTree
+
+from .utils import atomic_write
+
+__all__ = "clear", "collect", "summarize", "write_junit", "write_json"
+
+def _results_dir(path):
+    return os.path.join(path, "tests", ".tests")
+
+def clear(path):
+    """Remove the test outputs sconsUtils left in a package by earlier runs.
+
+    sconsUtils doesn't rerun tests whose outputs are up to date, and leaves the outputs of tests
+    that have since been removed, so without this the results of a run would be incomplete (or
+    include tests that no longer exist).
+    """
+    directory = _results_dir(path)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+def collect(path):
+    """Return (passed, failed) for the tests sconsUtils ran in the given package directory.
+
+    sconsUtils writes the output of each test to tests/.tests/NAME, renamed to NAME.failed if the
+    test failed.
+    """
+    directory = _results_dir(path)
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return [], []
+    passed = []
+    failed = []
+    for name in names:
+        filename = os.path.join(directory, name)
+        if not os.path.isfile(filename) or name.startswith("."):
+            continue
+        if name.endswith(".failed"):
+            with open(filename, "r") as file:
+                output = file.read()
+            failed.append({"name": name[:-len(".failed")], "output": output.decode("utf-8", "replace")})
+        elif not name.endswith(".xml"):  # pytest's own JUnit output, not a test
+            passed.append(name)
+    return passed, failed
+
+def summarize(results):
+    """Return a dict of the number of packages with each status."""
+    counts = {"passed": 0, "failed": 0, "error": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return counts
+
+def write_junit(filename, results, name="bot"):
+    """Write results as JUnit XML, with one testsuite per package."""
+    root = ElementTree.Element("testsuites", name=name)
+    total = {"tests": 0, "failures": 0, "errors": 0, "time": 0.0}
+    for result in results:
+        errors = 1 if result["status"] == "error" else 0
+        suite = ElementTree.SubElement(root, "testsuite", name=result["package"],
+                                       tests=str(len(result["passed"]) + len(result["failed"]) + errors),
+                                       failures=str(len(result["failed"])), errors=str(errors),
+                                       time="{0:.3f}".format(result["duration"]))
+        for test in result["passed"]:
+            ElementTree.SubElement(suite, "testcase", classname=result["package"], name=test)
+        for test in result["failed"]:
+            case = ElementTree.SubElement(suite, "testcase", classname=result["package"], name=test["name"])
+            failure = ElementTree.SubElement(case, "failure", message="{0} failed".format(test["name"]))
+            failure.text = test["output"]
+        if errors:
+            case = ElementTree.SubElement(suite, "testcase", classname=result["package"], name="scons")
+            ElementTree.SubElement(case, "error", message="'scons tests' failed; see the scons log")
+        for key in ("tests", "failures", "errors"):
+            total[key] += int(suite.get(key))
+        total["time"] += result["duration"]
+    for key, value in total.iteritems():
+        root.set(key, "{0:.3f}".format(value) if key == "time" else str(value))
+    with atomic_write(filename) as output:
+        ElementTree.ElementTree(root).write(output, encoding="utf-8")
+
+def write_json(filename, results, **extra):
+    """Write results as JSON, along with a summary and any extra top-level keys."""
+    data = dict(extra, summary=summarize(results), packages=results)
+    with atomic_write(filename) as output:
+        json.dump(data, output, indent=1, sort_keys=True)
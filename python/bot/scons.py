@@ -1,19 +1,148 @@
 #!/usr/bin/env python
 
 import os
+import json
+import logging
+import tempfile
+import threading
 import subprocess
 from .utils import echo
 
 class Error(RuntimeError): pass
 
-def run(config, path, *args):
-    olddir = os.path.abspath(os.getcwd())
-    os.chdir(path)
+# Serializes writes of captured output to the scons log.
+_log_lock = threading.Lock()
+
+def _fail(path, args):
+    return Error("'{0}' in path '{1}' failed".format(" ".join(("scons",) + tuple(args)), path))
+
+def start(config, path, *args):
+    """Start scons in the given path and return the subprocess.Popen object without waiting for it.
+    """
+    scons_cmd = ("scons",) + args
+    echo(config.scons, "In {0}, running '{1}'".format(path, " ".join(scons_cmd)))
+    return subprocess.Popen(scons_cmd, cwd=path, stderr=config.scons.stderr, stdout=config.scons.stdout)
+
+class Forkserver(object):
+    """A Python process with SCons already imported, which forks a child to run scons for each
+    package instead of starting (and importing) scons from scratch; see sconsd.py.
+
+    Output of children run without an output file goes to the given stderr, as scons' stdout and
+    stderr both would with a subprocess.
+    """
+
+    def __init__(self, stderr=None):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sconsd.py")
+        self.process = subprocess.Popen(("python", script), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=stderr)
+        reply = self._receive()
+        if "error" in reply:
+            self.close()
+            raise OSError(reply["error"])
+
+    def _receive(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise OSError("scons fork server exited unexpectedly")
+        return json.loads(line)
+
+    def run(self, path, args, env=None, output=None):
+        """Run scons with the given arguments in a child process and return its exit status."""
+        if env is None:
+            env = dict(os.environ)
+        request = {"path": os.path.abspath(path), "args": list(args), "env": env, "output": output}
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        return self._receive()["returncode"]
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+# Idle fork servers, by the stderr their children write to (None for captured runs).
+_forkservers = {}
+_forkservers_lock = threading.Lock()
+_forkservers_broken = False
+
+def _acquire(stderr=None):
+    """Return an idle Forkserver, starting one if necessary, or None if they don't work here."""
+    global _forkservers_broken
+    with _forkservers_lock:
+        if _forkservers_broken:
+            return None
+        idle = _forkservers.get(stderr)
+        if idle:
+            return idle.pop()
     try:
-        scons_cmd = ("scons",) + args
-        echo(config.scons, "In {0}, running '{1}'".format(path, " ".join(scons_cmd)))
-        subprocess.check_call(scons_cmd, stderr=config.scons.stderr, stdout=config.scons.stdout)
-    except subprocess.CalledProcessError:
-        raise Error("'{0}' in path '{1}' failed".format(" ".join(scons_cmd), path))
-    finally:
-        os.chdir(olddir)
+        return Forkserver(stderr)
+    except (OSError, ValueError) as err:
+        with _forkservers_lock:
+            if not _forkservers_broken:
+                logging.warning("Not forking scons from a warm process ({0}); "
+                                "starting scons normally instead.".format(err))
+            _forkservers_broken = True
+        return None
+
+def _release(server, stderr=None):
+    with _forkservers_lock:
+        _forkservers.setdefault(stderr, []).append(server)
+
+def _lost(server, err):
+    logging.warning("scons fork server failed ({0}); starting scons normally instead.".format(err))
+    try:
+        server.close()
+    except (IOError, OSError):
+        pass
+
+def run(config, path, *args):
+    if config.scons.fork:
+        server = _acquire(config.scons.stderr)
+        if server is not None:
+            echo(config.scons, "In {0}, running '{1}'".format(path, " ".join(("scons",) + args)))
+            try:
+                returncode = server.run(path, args)
+            except (IOError, OSError, ValueError) as err:
+                _lost(server, err)
+            else:
+                _release(server, config.scons.stderr)
+                if returncode != 0:
+                    raise _fail(path, args)
+                return
+    process = start(config, path, *args)
+    if process.wait() != 0:
+        raise _fail(path, args)
+
+def capture(path, args, env=None, fork=False):
+    """Run scons in the given path with its output captured instead of sent to the log, so several
+    can run at once (or on another machine).  Returns (returncode, output).
+
+    If fork is True, scons is forked from a warm process (see Forkserver) when possible.
+    """
+    server = _acquire() if fork else None
+    if server is not None:
+        output = tempfile.NamedTemporaryFile(prefix="bot-scons-", suffix=".log")
+        with output:
+            try:
+                returncode = server.run(path, args, env, output.name)
+            except (IOError, OSError, ValueError) as err:
+                _lost(server, err)
+            else:
+                _release(server)
+                return returncode, output.read()
+    process = subprocess.Popen(("scons",) + tuple(args), cwd=path, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, unused = process.communicate()
+    return process.returncode, output
+
+def report(config, path, args, returncode, output):
+    """Write the output of a captured scons run to the log as run() would have, and raise Error
+    if it failed.
+    """
+    with _log_lock:
+        echo(config.scons, "In {0}, ran '{1}'".format(path, " ".join(("scons",) + tuple(args))))
+        if isinstance(output, unicode):
+            output = output.encode("utf-8")
+        config.scons.stdout.write(output)
+        config.scons.stdout.flush()
+    if returncode != 0:
+        raise _fail(path, args)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""A warm scons process: imports SCons once, then forks a child to run scons for each request.
+
+This is run as a script (not imported) by bot.scons.Forkserver, with whatever 'python' is on the
+PATH, as the scons script itself would be.  Requests are read from stdin as JSON objects, one per
+line, of the form {"path": DIR, "args": [...], "env": {...}, "output": FILE or null}; for each, a
+JSON object {"returncode": N} is written to stdout when the child finishes.  The child's output goes
+to FILE if given, and otherwise to this process' stderr.
+
+The first line written is {"ready": true}, or {"error": MESSAGE} if SCons could not be imported.
+
+Only SCons itself is imported ahead of time: sconsUtils (and anything else a SConstruct imports)
+inspects the command line and environment when it is imported, so it is left to each child.
+"""
+
+import os
+import sys
+import glob
+import json
+import signal
+import traceback
+
+def _import_scons():
+    """Import SCons.Script from where the scons script on the PATH would: SCONS_LIB_DIR, then the
+    directories next to and below the script's prefix, and only then the rest of sys.path (so an
+    SCons installed with this Python doesn't win over the one EUPS has setup).
+
+    Returns None on success, or an error message.
+    """
+    candidates = []
+    if os.environ.get("SCONS_LIB_DIR"):
+        candidates.append(os.environ["SCONS_LIB_DIR"])
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        if directory and os.path.isfile(os.path.join(directory, "scons")):
+            directory = os.path.abspath(directory)
+            prefix = os.path.dirname(directory)
+            candidates.extend(sorted(glob.glob(os.path.join(directory, "scons-local*")), reverse=True))
+            candidates.extend(sorted(glob.glob(os.path.join(prefix, "lib", "scons*")), reverse=True))
+            candidates.extend(glob.glob(os.path.join(prefix, "lib", "python*", "site-packages")))
+            candidates.append(os.path.join(prefix, "engine"))
+            break
+    for candidate in candidates:
+        if not os.path.isdir(os.path.join(candidate, "SCons")):
+            continue
+        sys.path.insert(0, candidate)
+        try:
+            import SCons.Script
+            return None
+        except ImportError:
+            del sys.path[0]
+            for name in [name for name in sys.modules if name == "SCons" or name.startswith("SCons.")]:
+                del sys.modules[name]
+    try:
+        import SCons.Script
+        return None
+    except ImportError:
+        pass
+    return "could not import SCons (tried {0} and sys.path)".format(", ".join(candidates) or "nothing else")
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def _child(request):
+    """Run scons for a single request in a freshly-forked process; never returns."""
+    returncode = 1
+    try:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        sys.stdin.close()
+        if request.get("output"):
+            fd = os.open(request["output"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+        else:
+            os.dup2(2, 1)
+        os.chdir(request["path"])
+        os.environ.clear()
+        os.environ.update((_encode(k), _encode(v)) for k, v in request["env"].iteritems())
+        # the environment may have changed (e.g. packages setup) since we started
+        extra = [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p and p not in sys.path]
+        sys.path[:0] = extra
+        sys.argv = ["scons"] + [_encode(arg) for arg in request["args"]]
+        import SCons.Script
+        SCons.Script.main()
+        returncode = 0
+    except SystemExit as err:
+        if err.code is None:
+            returncode = 0
+        elif isinstance(err.code, int):
+            returncode = err.code
+        else:
+            sys.stderr.write("{0}\n".format(err.code))
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(returncode)
+
+def main():
+    # keep anything written to stdout by SCons out of our replies
+    control = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    def reply(obj):
+        control.write(json.dumps(obj) + "\n")
+        control.flush()
+
+    # an interrupt reaches the running child (and bot) directly; we just report how it exited
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    error = _import_scons()
+    if error is not None:
+        reply({"error": error})
+        return
+    reply({"ready": True})
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            control.close()
+            _child(request)
+        unused, status = os.waitpid(pid, 0)
+        if os.WIFEXITED(status):
+            reply({"returncode": os.WEXITSTATUS(status)})
+        else:
+            reply({"returncode": 128 + os.WTERMSIG(status)})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Support for 'bot serve', a long-lived daemon that keeps a repo set loaded in memory.
+
+The daemon loads the config, the RepoSet (including its chain of base RepoSets), the package list,
+the dependency graph and the EUPS database once, then listens on a Unix socket in the repo set
+directory that only the daemon's own user may connect to.  Each request is handled by a forked
+child that inherits all of that state, receives the client's stdin/stdout/stderr file descriptors
+and environment, and runs the command exactly as 'bot' would in-process (reading the EUPS database
+again if the client's EUPS environment differs from the daemon's).  The daemon reloads itself
+(EUPS database included) when any botconfig, packages or dependencies file in the repo set (or its
+bases), or the EUPS database, changes.
+"""
+
+from . import config
+from . import repo
+from . import eups
+
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import traceback
+from multiprocessing.reduction import send_handle, recv_handle
+
+__all__ = "State", "serve", "forward", "socket_path"
+
+SOCKET_NAME = ".bot.sock"
+
+# The State being served; only set in the daemon and its forked request handlers.
+state = None
+
+def socket_path(path):
+    """Return the path to the daemon socket for the repo set at path."""
+    return os.path.join(path, SOCKET_NAME)
+
+class State(object):
+    """The loaded config and RepoSet for a repo set, and the modification times of the files
+    they were loaded from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.config = config.load(path)
+        self.repos = repo.RepoSet(self.config)
+        try:
+            self.repos.read_list()
+            self.repos.read_dependencies()
+        except RuntimeError:
+            logging.info("Repo set at '{path}' has not been synced; serving config only.".format(path=path))
+        eups.get_eups()
+        self.eups_context = eups.context()
+        self.stamp = self._stamp()
+
+    def _watched(self):
+        """Return the files whose modification should trigger a reload."""
+        result = []
+        repos = self.repos
+        while repos is not None:
+            result.extend(config.files(repos.config.path))
+            result.append(os.path.join(repos.config.path, "packages"))
+            result.append(os.path.join(repos.config.path, "dependencies"))
+            repos = repos.base
+        # declarations made by commands we ran (or anything else) invalidate the cached EUPS database
+        for eups_path in eups.get_eups().path:
+            db = os.path.join(eups_path, "ups_db")
+            result.append(db)
+            try:
+                result.extend(os.path.join(db, product) for product in sorted(os.listdir(db)))
+            except OSError:
+                pass
+        return result
+
+    def _stamp(self):
+        result = []
+        for f in self._watched():
+            try:
+                result.append(os.stat(f).st_mtime)
+            except OSError:
+                result.append(None)
+        return result
+
+    def stale(self):
+        """Return True if any of the files the state was loaded from have changed."""
+        return self._stamp() != self.stamp
+
+# Strings in requests are sent as latin-1, which (unlike UTF-8) round-trips arbitrary bytes: the
+# client's environment and arguments needn't be valid in any encoding.
+def _pack(value):
+    return value.decode("latin-1")
+
+def _unpack(value):
+    return value.encode("latin-1")
+
+def _handle(listener, conn):
+    """Run a single request in a forked child; never returns."""
+    from . import commands
+    status = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        listener.close()
+        for fd in (0, 1, 2):
+            received = recv_handle(conn)
+            os.dup2(received, fd)
+            os.close(received)
+        reader = conn.makefile("r")
+        request = json.loads(reader.readline())
+        conn.sendall("{0}\n".format(os.getpid()))
+        os.chdir(_unpack(request["cwd"]))
+        os.environ.clear()
+        os.environ.update((_unpack(k), _unpack(v)) for k, v in request["env"].iteritems())
+        if eups.context() != state.eups_context:
+            # the client has a different EUPS_PATH or setup state than we started with
+            eups.reset()
+        try:
+            commands.main([_unpack(arg) for arg in request["argv"]])
+            status = 0
+        except SystemExit as err:
+            if err.code is None:
+                status = 0
+            elif isinstance(err.code, int):
+                status = err.code
+            else:
+                sys.stderr.write("{0}\n".format(err.code))
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall("{0}\n".format(status))
+        finally:
+            os._exit(0)
+
+def serve(path):
+    """Serve commands for the repo set at path until interrupted."""
+    global state
+    address = socket_path(path)
+    if os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except socket.error:
+            os.remove(address)
+        else:
+            raise RuntimeError("A bot daemon is already serving '{path}'".format(path=path))
+        finally:
+            probe.close()
+    state = State(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only our own user may connect: requests run commands as us, in an environment of their choosing
+    umask = os.umask(0077)
+    try:
+        listener.bind(address)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # handlers are reaped automatically
+    logging.info("Serving '{path}' on '{address}'.".format(path=path, address=address))
+    try:
+        while True:
+            conn, unused = listener.accept()
+            if state.stale():
+                logging.info("Configuration or package list changed; reloading.")
+                eups.reset()  # the EUPS database may be what changed
+                try:
+                    state = State(path)
+                except Exception:
+                    # better to let clients fall back to running in-process (and see the error
+                    # there) than to serve stale state
+                    logging.exception("Reload failed; shutting down.")
+                    conn.close()
+                    break
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                _handle(listener, conn)
+            conn.close()
+    finally:
+        listener.close()
+        os.remove(address)
+
+def forward(argv, path):
+    """Run a bot command in the daemon serving the repo set at path.
+
+    Returns the command's exit status, or None if no daemon is running (in which case the
+    command should be run in-process).
+    """
+    address = socket_path(path)
+    if not os.path.exists(address):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(address)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd in (0, 1, 2):
+            send_handle(conn, fd, None)
+        env = dict((_pack(k), _pack(v)) for k, v in os.environ.iteritems())
+        request = {"argv": [_pack(arg) for arg in argv], "cwd": _pack(os.getcwd()), "env": env}
+        conn.sendall(json.dumps(request) + "\n")
+        reader = conn.makefile("r")
+        pid = reader.readline()
+    except socket.error:
+        conn.close()
+        return None
+    if not pid:
+        # the daemon went away before it started running the command
+        return None
+    try:
+        try:
+            status = reader.readline()
+        except KeyboardInterrupt:
+            os.kill(int(pid), signal.SIGINT)
+            status = reader.readline()
+    finally:
+        conn.close()
+    return int(status) if status else 1
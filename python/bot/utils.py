@@ -1,5 +1,13 @@
-import logging
+import os
 import sys
+import fcntl
+import logging
+import tempfile
+import contextlib
+
+# The process umask, which can only be read by setting it.
+_umask = os.umask(0)
+os.umask(_umask)
 
 def echo(config, message):
     logging.log(config.echo, message)
@@ -9,3 +17,35 @@ def echo(config, message):
     if config.stdout != sys.stderr and config.stdout != sys.stdout and config.stdout != config.stderr:
         config.stdout.write("\n#---- bot: {0} ----\n".format(message))
         config.stdout.flush()
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    """Open a temporary file for writing, and rename it to filename when the block completes
+    successfully, so readers see either the old contents or the new ones.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    output = tempfile.NamedTemporaryFile(dir=directory, prefix=".{0}.".format(name), delete=False)
+    try:
+        yield output
+        output.close()
+        os.chmod(output.name, 0666 & ~_umask)  # not the 0600 of a temporary file
+        os.rename(output.name, filename)
+    except:
+        output.close()
+        os.remove(output.name)
+        raise
+
+def open_log(filename):
+    """Open a log file for use in botconfig, truncating it unless another bot process is already
+    writing to it, in which case our output is appended instead.
+    """
+    file = open(filename, "a")
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        pass
+    else:
+        file.truncate(0)
+    # held until the file is closed, to tell later processes not to truncate it
+    fcntl.flock(file.fileno(), fcntl.LOCK_SH)
+    return file
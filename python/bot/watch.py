@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""Support for 'bot build --watch': rebuild packages (and the packages that depend on them) as their
+sources change.
+
+Changes are detected with Linux inotify when it is available, falling back to polling modification
+times elsewhere (or when we run out of inotify watches).  Files ignored by a package's .gitignore
+(which for LSST packages includes all build products) and scons' own bookkeeping files do not trigger
+rebuilds.  While a package is being built, only changes to files git tracks in it count, since
+anything else new there is most likely the build's own output.
+"""
+
+from . import scons
+from . import lock
+
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import subprocess
+import ctypes
+import ctypes.util
+
+__all__ = "Inotify", "Poller", "watch"
+
+class Inotify(object):
+    """Minimal ctypes wrapper for Linux inotify that watches directory trees recursively.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch  # AttributeError if libc has no inotify
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.roots = []
+        self.watches = {}
+
+    def add_tree(self, top):
+        """Watch a directory and all of its subdirectories (except .git)."""
+        if top not in self.roots:
+            self.roots.append(top)
+        self._add_tree(top)
+
+    def _add_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if d != ".git"]
+            wd = self._add_watch(self.fd, dirpath, self.MASK)
+            if wd >= 0:
+                self.watches[wd] = dirpath
+                continue
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "cannot watch '{0}' ({1}; see fs.inotify.max_user_watches)".format(
+                    dirpath, os.strerror(err)))
+            if err != errno.ENOENT:  # already gone again
+                logging.warning("Not watching '{0}' for changes: {1}".format(dirpath, os.strerror(err)))
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for events, and return the set of paths
+        that changed.
+
+        Raises OSError (with errno ENOSPC) if a new directory can't be watched because we have
+        run out of inotify watches.
+        """
+        ready, unused1, unused2 = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # we've lost events; everything may have changed
+                changed.update(self.roots)
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) and name != ".git":
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+class Poller(object):
+    """Fallback for platforms without inotify: periodically compare modification times.
+    """
+
+    interval = 1.0
+
+    def __init__(self):
+        self.roots = []
+        self.stamps = {}
+
+    def add_tree(self, top):
+        """Watch a directory and all of its subdirectories (except .git)."""
+        self.roots.append(top)
+        self.stamps.update(self._scan(top))
+
+    @staticmethod
+    def _scan(top):
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if d != ".git"]
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    result[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return result
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes, and return the set of paths
+        that changed.
+        """
+        start = time.time()
+        while True:
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+            current = {}
+            for top in self.roots:
+                current.update(self._scan(top))
+            changed = set(path for path in set(current) | set(self.stamps)
+                          if current.get(path) != self.stamps.get(path))
+            self.stamps = current
+            if changed or (timeout is not None and time.time() - start >= timeout):
+                return changed
+
+    def close(self):
+        pass
+
+def _scons_file(root, path):
+    """Return True if path is a file scons writes for itself in any package (whether or not git
+    ignores it).
+    """
+    for part in os.path.relpath(path, root).split(os.sep):
+        if part.startswith(".sconsign") or part in (".sconf_temp", "config.log"):
+            return True
+    return False
+
+def _ignored(path, files):
+    """Return the subset of files (absolute paths within the git repo at path) that git ignores."""
+    if not os.path.isdir(os.path.join(path, ".git")):
+        return set()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen(("git", "check-ignore", "--stdin"), cwd=path, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=devnull)
+        output, unused = process.communicate("".join(os.path.relpath(f, path) + "\n" for f in files))
+    return set(os.path.join(path, line) for line in output.splitlines())
+
+def _tracked(path, files):
+    """Return the subset of files (absolute paths within the repo at path) that git tracks, or all
+    of them if path isn't a git repo.
+    """
+    if not os.path.isdir(os.path.join(path, ".git")) or not files:
+        return set(files)
+    with open(os.devnull, "w") as devnull:
+        names = tuple(os.path.relpath(f, path) for f in files)
+        process = subprocess.Popen(("git", "ls-files", "-z", "--") + names, cwd=path,
+                                   stdout=subprocess.PIPE, stderr=devnull)
+        output, unused = process.communicate()
+    return set(os.path.join(path, name) for name in output.split("\0") if name)
+
+def _changes(watcher, roots, timeout, building=None):
+    """Return the set of packages with relevant source changes within timeout seconds
+    (waiting forever if timeout is None).
+
+    In the package being built (if any), only changes to files git tracks are relevant; anything
+    else written there is assumed to be the build's own output.
+    """
+    while True:
+        files = {}
+        for f in watcher.read(timeout):
+            for root, pkg in roots.iteritems():
+                if f == root or f.startswith(root + os.sep):
+                    if not _scons_file(root, f):
+                        files.setdefault(root, set()).add(f)
+                    break
+        changed = set()
+        for root, paths in files.iteritems():
+            # a change to the root itself (i.e. queue overflow) always counts
+            if root in paths:
+                changed.add(roots[root])
+                continue
+            paths -= _ignored(root, paths)
+            if roots[root] == building:
+                paths = _tracked(root, paths)
+            if paths:
+                changed.add(roots[root])
+        if changed or timeout is not None:
+            return changed
+
+def _debounce(watcher, roots, changed, delay):
+    """Add to changed until no further changes arrive for delay seconds."""
+    while True:
+        more = _changes(watcher, roots, delay)
+        if not more:
+            return changed
+        changed |= more
+
+def _watcher(roots, poll=False):
+    """Return an Inotify watching the given directory trees, or a Poller if poll is True, inotify
+    isn't available, or there aren't enough inotify watches for all of them.
+    """
+    watcher = None
+    try:
+        if not poll:
+            watcher = Inotify()
+            for root in roots:
+                watcher.add_tree(root)
+            return watcher
+    except (AttributeError, OSError) as err:
+        logging.warning("inotify not available ({0}); polling for changes instead.".format(err))
+        if watcher is not None:
+            watcher.close()
+    watcher = Poller()
+    for root in roots:
+        watcher.add_tree(root)
+    return watcher
+
+def watch(repos, *args, **kw):
+    """Watch the managed packages in a RepoSet and rebuild changed packages and their dependents,
+    in dependency order, until interrupted.
+
+    Builds that are in progress when newer changes arrive (including changes to the tracked files
+    of the package being built) are cancelled and rescheduled.
+
+    The stack locks (see RepoSet.lock) and the package's own lock are held only while each build
+    runs, so other commands can work on the stack while we wait for changes.
+    """
+    delay = kw.get("delay", 1.0)
+    roots = dict((os.path.abspath(repos.path(pkg)), pkg) for pkg in repos.packages
+                 if pkg not in repos.inherited or kw.get("inherited"))
+    watcher = _watcher(roots)
+    watched = set(roots.itervalues())
+    logging.info("Watching {0} packages for changes.".format(len(watched)))
+    pending = []
+    try:
+        while True:
+            try:
+                if not pending:
+                    changed = _debounce(watcher, roots, _changes(watcher, roots, None), delay)
+                    pending = [pkg for pkg in repos.dependents(changed) if pkg in watched]
+                    logging.info("Changes detected; rebuilding {0}.".format(", ".join(pending)))
+                pkg = pending.pop(0)
+                held = repos.lock()
+                held.append(lock.package(repos.path(pkg)).acquire())
+                process = None
+                try:
+                    logging.info("Building '{pkg}'...".format(pkg=pkg))
+                    process = scons.start(repos.config, repos.path(pkg), *args)
+                    changed = set()
+                    while process.poll() is None:
+                        changed = _changes(watcher, roots, 0.5, building=pkg)
+                        if changed:
+                            logging.info("New changes in {0}; cancelling build of '{1}'.".format(
+                                ", ".join(sorted(changed)), pkg))
+                            process.terminate()
+                            process.wait()
+                            break
+                finally:
+                    if process is not None and process.poll() is None:
+                        process.terminate()
+                        process.wait()
+                    for held_lock in reversed(held):
+                        held_lock.release()
+                if changed:
+                    changed = _debounce(watcher, roots, changed, delay)
+                    changed.add(pkg)
+                    changed.update(pending)
+                    pending = [p for p in repos.dependents(changed) if p in watched]
+                else:
+                    # pick up edits made during the last moments of the build
+                    changed = _changes(watcher, roots, 0, building=pkg)
+                    if process.returncode != 0:
+                        skipped = set(repos.dependents([pkg]))
+                        pending = [p for p in pending if p not in skipped]
+                        logging.warning("Build for '{pkg}' failed; skipping packages that depend on "
+                                        "it.".format(pkg=pkg))
+                    if changed:
+                        pending = [p for p in repos.dependents(changed | set(pending)) if p in watched]
+            except OSError as err:
+                if err.errno != errno.ENOSPC or isinstance(watcher, Poller):
+                    raise
+                logging.warning("Ran out of inotify watches ({0}); polling for changes instead.".format(err))
+                watcher.close()
+                watcher = _watcher(roots, poll=True)
+                # changes may have been missed, so check everything (scons skips what's up to date)
+                pending = [p for p in repos.packages if p in watched]
+    except KeyboardInterrupt:
+        pass  # any build in progress was terminated above